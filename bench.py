@@ -0,0 +1,445 @@
+#!/bin/python
+
+# Benchmarks for builder's own overhead. Each benchmark builds a synthetic
+# project in a temporary directory and drives builder.py in-process.
+
+import sys,os,argparse,json,tempfile,time,shutil,random,tracemalloc
+
+import builder
+
+def WriteFile(path,text):
+    d = os.path.dirname(path)
+    if d and not os.path.exists(d):
+        os.makedirs(d)
+    with open(path,'w') as f:
+        f.write(text)
+
+def RewriteFile(path): # rewrite a file with the same contents, like a checkout would
+    with open(path,'r') as f:
+        text = f.read()
+    WriteFile(path,text)
+
+def HeaderName(i):
+    return f'h{i}.h'
+
+def SourceName(i):
+    return os.path.join('src',f's{i}.cpp')
+
+STUB_COMPILER = '''#!/bin/sh
+# stand-in compiler: creates the file following -o and ignores everything else
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-o" ]; then
+        shift
+        echo stub > "$1"
+    fi
+    shift
+done
+'''
+
+def GenerateProject(root,sources,headers,options=None):
+    stub = os.path.join(root,'stubcc')
+    WriteFile(stub,STUB_COMPILER)
+    os.chmod(stub,0o755)
+
+    for i in range(headers):
+        includes = ''
+        if i+1<headers:
+            includes = f'#include "{HeaderName(i+1)}"\n'
+        WriteFile(os.path.join(root,'include',HeaderName(i)),f'#pragma once\n{includes}int h{i}();\n')
+
+    for i in range(sources):
+        WriteFile(os.path.join(root,SourceName(i)),f'#include "{HeaderName(i%headers)}"\nint s{i}(){{ return 0; }}\n')
+
+    op = {
+        'compileCmd':['./stubcc','-o','%out','%in'],
+        'linkCmd':['./stubcc','-o','%out','%in'],
+        'outputName':'out',
+        'srcDirs':['src'],
+        'includeDirs':['include'],
+        'objDir':['build','%modePath'],
+        'outputDir':['bin','%modePath'],
+        'modes':{'bench':{}}
+    }
+    if options:
+        op.update(options)
+    WriteFile(os.path.join(root,'builder.json'),json.dumps(op,indent=4))
+
+def GenerateTree(root,args): # layered headers spread over include dirs, each including fanout headers of the next layer
+    rng = random.Random(args.seed)
+    stub = os.path.join(root,'stubcc')
+    WriteFile(stub,STUB_COMPILER)
+    os.chmod(stub,0o755)
+
+    depth = max(1,args.depth)
+    layers = [[] for _ in range(depth)]
+    for i in range(args.headers):
+        layers[i*depth//args.headers].append(i)
+    includeDirs = [f'inc{d}' for d in range(args.include_dirs)]
+
+    for layer,headers in enumerate(layers):
+        below = layers[layer+1] if layer+1<depth else []
+        for i in headers:
+            includes = ''.join(f'#include "{HeaderName(h)}"\n' for h in rng.sample(below,min(args.fanout,len(below))))
+            WriteFile(os.path.join(root,includeDirs[i%len(includeDirs)],HeaderName(i)),f'#pragma once\n#include <vector>\n{includes}int h{i}();\n')
+
+    for i in range(args.sources):
+        includes = ''.join(f'#include "{HeaderName(h)}"\n' for h in rng.sample(layers[0],min(args.fanout,len(layers[0]))))
+        WriteFile(os.path.join(root,'src',f'dir{i%50}',f's{i}.cpp'),f'#include <string>\n{includes}int s{i}(){{ return 0; }}\n')
+
+    op = {
+        'compileCmd':['./stubcc','-c','-O2','-o','%out','%in'],
+        'linkCmd':['./stubcc','-o','%out','%in'],
+        'outputName':'out',
+        'srcDirs':['src'],
+        'includeDirs':includeDirs,
+        'objDir':['build','%modePath'],
+        'outputDir':['bin','%modePath'],
+        'modes':{'bench':{}}
+    }
+    WriteFile(os.path.join(root,'builder.json'),json.dumps(op,indent=4))
+    return layers
+
+def RunBuild(mode='bench'):
+    options = builder.GetOptionsFromFile('builder.json')
+    b = builder.Builder(options)
+    b.builderFile = 'builder.json'
+    b.quiet = True
+    b.Build(mode.split('/'))
+    return len(b.rebuildList)
+
+def Settle():
+    time.sleep(0.02) # make sure rewritten files get a newer mtime than the objects
+
+def BenchRebuilds(args): # count rebuilt objects after checkouts that do not change contents
+    results = {}
+    for name,contentHash in (('mtime',False),('hash',True)):
+        root = tempfile.mkdtemp(prefix='builder-bench-')
+        cwd = os.getcwd()
+        try:
+            GenerateProject(root,args.sources,args.headers,{'contentHash':contentHash})
+            os.chdir(root)
+            runs = {'clean':RunBuild()}
+
+            Settle()
+            for i in range(args.headers):
+                RewriteFile(os.path.join('include',HeaderName(i)))
+            runs['touch all headers'] = RunBuild()
+
+            Settle()
+            changed = [SourceName(i) for i in range(0,args.sources,4)]
+            originals = {}
+            for path in changed: # switch to a branch and straight back without building
+                with open(path,'r') as f:
+                    originals[path] = f.read()
+                WriteFile(path,originals[path]+'// other branch\n')
+            for path in changed:
+                WriteFile(path,originals[path])
+            runs['branch switch and back'] = RunBuild()
+
+            Settle()
+            header = os.path.join('include',HeaderName(args.headers//2))
+            with open(header,'a') as f:
+                f.write('int extra();\n')
+            runs['real header change'] = RunBuild()
+
+            Settle() # a header next to the sources now wins include resolution over the one in include
+            WriteFile(os.path.join('src',HeaderName(0)),'int shadow();\n')
+            runs['shadowing header added'] = RunBuild()
+            expected = len(range(0,args.sources,args.headers))
+            if runs['shadowing header added']!=expected:
+                print(f"Expected {expected} sources to rebuild after {HeaderName(0)} was shadowed!")
+                sys.exit(1)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(root)
+        results[name] = runs
+
+    return results
+
+NESTED_MODES = {
+    'compileCmd':['g++ -c','%compileFlags','%warnings','%defines'],
+    'linkCmd':['g++','%linkFlags'],
+    'compileFlags':['-std=c++20','-o','%out','%in'],
+    'linkFlags':['-o','%out','%in'],
+    'warnings':['-Wall','-Wextra','-Wpedantic'],
+    'defines':['-DPROJECT=bench','-DPLATFORM=#','%platform'],
+    'srcDirs':[],
+    'includeDirs':['include','third_party/include',['gen','%modeLast']],
+    'objDir':['build','%modePath'],
+    'outputDir':['bin','%modePath'],
+    'platformModes':{
+        'debug':{'compileFlags':['%compileFlags','-g','-O0']},
+        'release':{
+            'compileFlags':['%compileFlags','-O3','-DNDEBUG'],
+            'modes':{'lto':{'compileFlags':['%compileFlags','-flto'],'linkFlags':['%linkFlags','-flto']}}
+        }
+    },
+    'modes':{'linux':{'modes':'%platformModes'},'windows':{'modes':'%platformModes'}}
+}
+
+def BenchCommands(args): # per-file command generation, resolving the mode every time vs a compiled mode
+    root = tempfile.mkdtemp(prefix='builder-bench-')
+    cwd = os.getcwd()
+    try:
+        os.chdir(root)
+        WriteFile('builder.json',json.dumps(NESTED_MODES,indent=4))
+        options = builder.GetOptionsFromFile('builder.json')
+        b = builder.Builder(options)
+        b.quiet = True
+        mode = b.FixMode(['linux','release'])
+        files = [os.path.join('src',f'dir{i%100}',f'file{i}.cpp') for i in range(args.files)]
+
+        start = time.perf_counter()
+        old = []
+        for file in files:
+            obj = os.path.join(b.GetPath(mode,'objDir'),builder.AddExtension(file,builder.GetModeVar(b.options,mode,'objExt')))
+            old.append(b.ResolveCompileArgs(mode,file,obj))
+        oldTime = time.perf_counter()-start
+
+        b.compiledModes = {}
+        start = time.perf_counter()
+        new = [b.GetCompileCommand(mode,file) for file in files]
+        newTime = time.perf_counter()-start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+    if old!=new:
+        print("Compiled mode commands differ from resolved commands!")
+        sys.exit(1)
+
+    return {'files':args.files,'resolved (s)':round(oldTime,4),'compiled (s)':round(newTime,4),'speedup':round(oldTime/newTime,1)}
+
+def Timed(func,*args):
+    start = time.perf_counter()
+    func(*args)
+    return round(time.perf_counter()-start,4)
+
+def BenchHotPaths(args): # time each phase of a build on its own, see --depth, --fanout and --include-dirs
+    results = {'sources':args.sources,'headers':args.headers,'depth':args.depth,'fanout':args.fanout,'include dirs':args.include_dirs}
+    root = tempfile.mkdtemp(prefix='builder-bench-')
+    cwd = os.getcwd()
+    try:
+        layers = GenerateTree(root,args)
+        os.chdir(root)
+        b = builder.Builder(builder.GetOptionsFromFile('builder.json'))
+        b.builderFile = 'builder.json'
+        b.quiet = True
+        mode = b.FixMode(['bench'])
+        srcDirs = b.GetPaths(mode,'srcDirs')
+        b.GetDepExtractFunc(mode)
+
+        builder.ResetStatCache()
+        results['collect sources (s)'] = Timed(b.CollectAllCompilables,mode,srcDirs,b.GetSourceExts(mode))
+        results['scan, no dep cache (s)'] = Timed(b.ScanAllDependencies,mode)
+        results['tracked files'] = len(b.depdict)
+        b.compiledModes = {}
+        results['command generation (s)'] = Timed(lambda: [b.GetCompileCommand(mode,file) for file in b.compileFiles])
+        results['rebuild set, clean (s)'] = Timed(b.GetRebuildSet,mode)
+        results['dispatch with stub compiler (s)'] = Timed(lambda: b.DispatchCommands(b.GetCompileList(mode,b.rebuildList)))
+
+        builder.ResetStatCache()
+        b.CollectAllCompilables(mode,srcDirs,b.GetSourceExts(mode))
+        results['scan, dep cache (s)'] = Timed(b.ScanAllDependencies,mode)
+        results['rebuild set, up to date (s)'] = Timed(b.GetRebuildSet,mode)
+
+        Settle()
+        header = layers[-1][0]
+        for d in b.GetPaths(mode,'includeDirs'):
+            if os.path.exists(os.path.join(d,HeaderName(header))):
+                RewriteFile(os.path.join(d,HeaderName(header)))
+        builder.ResetStatCache()
+        results['rebuild set, deepest header touched (s)'] = Timed(b.GetRebuildSet,mode)
+        results['rebuilt after header touch'] = len(b.rebuildList)
+
+        builder.ResetStatCache()
+        results['prune objects (s)'] = Timed(b.PruneObjects,mode)
+
+        RunBuild()
+        results['null build (s)'] = Timed(RunBuild)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+    return results
+
+def BenchSpawn(args): # per-job cost of starting a compiler through the shell, as argv and with posix_spawn, true stands in for it
+    root = tempfile.mkdtemp(prefix='builder-bench-')
+    cwd = os.getcwd()
+    methods = {
+        'shell':lambda cmd: builder.StartProcess(builder.JoinArgs(cmd),True).wait(),
+        'argv':lambda cmd: builder.StartProcess(cmd,True).wait()
+    }
+    if hasattr(os,'posix_spawn'):
+        methods['posix_spawn'] = lambda cmd: os.waitpid(os.posix_spawn(cmd[0],cmd,os.environ,setsid=True),0)
+    results = {'jobs':args.sources}
+    true = shutil.which('true') # a full path, so the shell cannot run it as a builtin
+    try:
+        os.chdir(root)
+        for name,method in methods.items():
+            start = time.perf_counter()
+            for i in range(args.sources):
+                method([true,'-c','-o',f'obj {i}.o',f'src {i}.cpp'])
+            results[f'{name} (ms/job)'] = round((time.perf_counter()-start)*1000/args.sources,3)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+    return results
+
+LARGE_HEADER_BODY = '''/* a block comment
+   spanning lines */
+template<typename T> struct Box{i} {{
+    T value; // the stored value
+    const char *name = "box {i}";
+    int Get() const {{ return value.size()*{i}; }}
+}};
+'''
+
+def BenchScanner(args): # extract includes from large headers with each dep scanner, see --lines
+    results = {'files':args.headers,'lines per file':args.lines}
+    root = tempfile.mkdtemp(prefix='builder-bench-')
+    cwd = os.getcwd()
+    try:
+        os.chdir(root)
+        paths = []
+        for i in range(args.headers):
+            includes = ''.join(f'#include "{HeaderName(j)}"\n' for j in range(i+1,min(i+4,args.headers)))
+            body = ''.join(LARGE_HEADER_BODY.format(i=j) for j in range(args.lines//7))
+            paths.append(os.path.join('include',HeaderName(i)))
+            WriteFile(paths[-1],f'#pragma once\n#include <vector>\n{includes}{body}')
+        results['MB scanned'] = round(sum(os.path.getsize(path) for path in paths)/1e6,1)
+
+        found = {}
+        for name,func in builder.DEP_SCANNERS.items():
+            builder.ResetStatCache()
+            start = time.perf_counter()
+            found[name] = [func(path,['include']) for path in paths]
+            results[f'{name} (s)'] = round(time.perf_counter()-start,4)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+    if len(set(str(deps) for deps in found.values()))!=1:
+        print("Dep scanners found different includes!")
+        sys.exit(1)
+
+    results['speedup'] = round(results['lines (s)']/results['regex (s)'],1)
+    return results
+
+def RandomGraph(args): # path -> included paths for --files files, a tenth of them headers
+    rng = random.Random(args.seed)
+    headers = [os.path.join('include',f'dir{i%200}',f'header{i}.h') for i in range(max(1,args.files//10))]
+    sources = [os.path.join('src',f'dir{i%500}',f'source{i}.cpp') for i in range(args.files-len(headers))]
+    graph = {}
+    for i,header in enumerate(headers): # headers only include later headers, like layers of a library
+        later = headers[i+1:i+1+200]
+        graph[header] = set(rng.sample(later,min(len(later),args.fanout)))
+    for source in sources:
+        graph[source] = set(rng.sample(headers,min(len(headers),args.fanout*4)))
+    return graph,sources,headers
+
+def BestTime(func,repeat): # the fastest of repeat runs, single runs vary too much to compare
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best,time.perf_counter()-start)
+        del result
+    return round(best,4)
+
+def Measured(build,repeat): # the object built, its size in MB and the time taken, timed without tracemalloc slowing it down
+    elapsed = BestTime(build,repeat)
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result,round(size/1e6,2),elapsed
+
+def BenchGraph(args): # builder's dict graph against the interned one (internGraph), see --files and --fanout
+    graph,sources,headers = RandomGraph(args)
+    rng = random.Random(args.seed)
+    mtimes = {path:rng.randrange(1<<40) for path in graph}
+    results = {'files':len(graph),'edges':sum(len(deps) for deps in graph.values())}
+
+    def Scan(graphType): # scanning stores a new set of includes per file, then compacts the graph
+        def Build():
+            depdict = graphType()
+            for path,deps in graph.items():
+                depdict[path] = set(deps)
+            depdict.Compact()
+            return depdict
+        return Build
+
+    # the rebuild set's pass over the condensed graph, with mtimes from a table instead of the stat cache
+    b = builder.Builder({'modes':{}})
+    getFileTime = builder.GetFileTime
+    builder.GetFileTime = mtimes.__getitem__
+    newest = {}
+    graphs = {}
+    try:
+        for name,graphType in (('dict graph',builder.DictGraph),('interned',builder.DepGraph)):
+            b.depdict,results[f'{name} (MB)'],results[f'{name}, scan (s)'] = Measured(Scan(graphType),args.repeat)
+            newest[name] = b.GetNewestDependencyTimes()
+            results[f'{name}, newest times (s)'] = BestTime(b.GetNewestDependencyTimes,args.repeat)
+            graphs[name] = b.depdict
+    finally:
+        builder.GetFileTime = getFileTime
+    results['interned, scan slowdown'] = round(results['interned, scan (s)']/results['dict graph, scan (s)'],2)
+    results['interned, newest times slowdown'] = round(results['interned, newest times (s)']/results['dict graph, newest times (s)'],2)
+
+    old,new = graphs['dict graph'],graphs['interned']
+    if newest['dict graph']!=newest['interned'] or any(old[path]!=new[path] for path in sources[:1000]):
+        print("Interned graph differs from the dict graph!")
+        sys.exit(1)
+    return results
+
+def PrintTable(results):
+    if not any(type(value) is dict for value in results.values()):
+        width = max(len(key) for key in results)+2
+        for key,value in results.items():
+            print(key.ljust(width)+str(value).rjust(10))
+        return
+
+    names = list(results.keys())
+    rows = list(results[names[0]].keys())
+    width = max(len(row) for row in rows)+2
+    print(''.ljust(width)+''.join(name.rjust(10) for name in names))
+    for row in rows:
+        print(row.ljust(width)+''.join(str(results[name][row]).rjust(10) for name in names))
+
+BENCHMARKS = {
+    'rebuilds':BenchRebuilds,
+    'commands':BenchCommands,
+    'hotpaths':BenchHotPaths,
+    'spawn':BenchSpawn,
+    'scanner':BenchScanner,
+    'graph':BenchGraph
+}
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench',description="Benchmarks for builder.")
+    parser.add_argument("benchmark",choices=list(BENCHMARKS.keys()),help="benchmark to run")
+    parser.add_argument("--sources",type=int,default=200,help="number of synthetic source files")
+    parser.add_argument("--headers",type=int,default=20,help="number of synthetic header files")
+    parser.add_argument("--files",type=int,default=50000,help="number of file names for the commands and graph benchmarks")
+    parser.add_argument("--depth",type=int,default=4,help="header include depth for the hotpaths benchmark")
+    parser.add_argument("--fanout",type=int,default=3,help="headers included by each file for the hotpaths benchmark")
+    parser.add_argument("--include-dirs",type=int,default=4,help="number of include dirs for the hotpaths benchmark")
+    parser.add_argument("--lines",type=int,default=20000,help="lines per header for the scanner benchmark")
+    parser.add_argument("--repeat",type=int,default=5,help="runs per timing for the graph benchmark, the fastest is reported")
+    parser.add_argument("--seed",type=int,default=1,help="random seed for the generated include graph")
+    parser.add_argument("--json",metavar='FILE',default='',help="also write the results to FILE as JSON")
+    args = parser.parse_args()
+
+    builder.noColor = True
+    results = BENCHMARKS[args.benchmark](args)
+    PrintTable(results)
+
+    if args.json: # results are keyed by benchmark so runs of different versions can be compared
+        data = {'benchmark':args.benchmark,'python':sys.version.split()[0],'time':int(time.time()),'results':results}
+        with open(args.json,'w') as f:
+            json.dump(data,f,indent=4)
+
+if __name__=='__main__':
+    main()
@@ -1,6 +1,7 @@
 #!/bin/python
 
-import sys,os,subprocess,argparse,json,threading,time,copy
+import sys,os,subprocess,argparse,json,threading,time,copy,hashlib,hmac,heapq,traceback,signal,shutil,select,struct,ctypes,socket,tempfile,shlex,re,fnmatch,mmap,array,itertools
+import concurrent.futures
 
 RED = 1
 GREEN = 2
@@ -46,14 +47,192 @@ def GetNumSize(num):
         c+=1
     return c
 
+class StatCache: # file metadata shared by a whole build, gathered with one os.scandir sweep per directory
+    def __init__(self):
+        self.dirs = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.sweeps = 0
+        self.statCalls = 0
+
+    def Sweep(self,d): # return {name: DirEntry} for directory d, None if it does not exist
+        if d in self.dirs:
+            return self.dirs[d]
+
+        with self.lock:
+            if d in self.dirs:
+                return self.dirs[d]
+            entries = None
+            try:
+                with os.scandir(d) as it:
+                    entries = {entry.name:entry for entry in it}
+            except OSError:
+                pass
+            self.sweeps += 1
+            self.dirs[d] = entries
+        return entries
+
+    def GetEntry(self,path):
+        path = os.path.normpath(path)
+        d,name = os.path.split(path)
+        if name in ('','.','..'):
+            return path,None
+        entries = self.Sweep(d or '.')
+        if entries is None:
+            return path,False
+        return path,entries.get(name,False)
+
+    def Stat(self,path): # return (mtime in ns, size) or None if path does not exist
+        self.lookups += 1
+        path,entry = self.GetEntry(path)
+        if entry is False:
+            return None
+        if path in self.stats:
+            return self.stats[path]
+
+        self.statCalls += 1
+        try:
+            st = entry.stat() if entry else os.stat(path)
+            stat = (st.st_mtime_ns,st.st_size)
+        except OSError:
+            stat = None
+        self.stats[path] = stat
+        return stat
+
+    def Exists(self,path):
+        self.lookups += 1
+        path,entry = self.GetEntry(path)
+        if entry is None:
+            return self.Stat(path) is not None
+        return entry is not False
+
+    def ListDir(self,path): # return [(name,isDir,isFile)], symlinks are followed like os.path.isdir
+        self.lookups += 1
+        entries = self.Sweep(os.path.normpath(path))
+        if entries is None:
+            raise FileNotFoundError(path)
+
+        l = []
+        for name,entry in entries.items():
+            try:
+                l.append((name,entry.is_dir(),entry.is_file()))
+            except OSError:
+                l.append((name,False,False))
+        return l
+
+    def Invalidate(self,path): # call after creating, writing or removing path
+        path = os.path.normpath(path)
+        with self.lock:
+            self.dirs.pop(os.path.dirname(path) or '.',None)
+            self.dirs.pop(path,None)
+            self.stats.pop(path,None)
+
+    def GetSavedCalls(self):
+        return self.lookups-self.sweeps-self.statCalls
+
+class IncludeResolver: # resolves include names against one list of include dirs, remembering misses too
+    def __init__(self,includeDirs,found):
+        self.includeDirs = includeDirs
+        self.found = found
+        self.resolved = {}
+        self.lookups = 0
+        self.hits = 0
+
+    def Find(self,d,name,probes=None): # (directory,name) results are shared by every resolver
+        if probes is not None: # a file created in any probed directory can change the result
+            probes.add(os.path.dirname(os.path.normpath(os.path.join(d,name))) or '.')
+        key = (d,name)
+        path = self.found.get(key)
+        if path is None:
+            test = os.path.join(d,name)
+            path = os.path.normpath(test) if statCache.Exists(test) else ''
+            self.found[key] = path
+        return path
+
+    def Resolve(self,name,probes=None):
+        self.lookups += 1
+        result = self.resolved.get(name)
+        if result is not None:
+            self.hits += 1
+        else:
+            path = ''
+            dirs = set()
+            for include in self.includeDirs:
+                path = self.Find(include,name,dirs)
+                if path:
+                    break
+            result = self.resolved[name] = (path,dirs)
+
+        if probes is not None:
+            probes.update(result[1])
+        return result[0]
+
+statCache = StatCache()
+includeResolvers = {}
+includeFound = {}
+
+def ResetStatCache(): # include lookups depend on directory contents, so they are dropped too
+    global statCache,includeResolvers,includeFound
+    statCache = StatCache()
+    includeResolvers = {}
+    includeFound = {}
+
+def GetIncludeResolver(includeDirs): # modes with different include dirs get different resolvers
+    key = tuple(includeDirs)
+    resolver = includeResolvers.get(key)
+    if resolver is None:
+        resolver = IncludeResolver(key,includeFound)
+        includeResolvers[key] = resolver
+    return resolver
+
 def IsObjFileOutdated(srcFile,objFile):
     return GetFileTime(srcFile)>=GetFileTime(objFile)
 
-def GetFileTime(filename):
-    if not os.path.exists(filename):
+def GetFileTime(filename): # mtime in ns, 0 if the file does not exist
+    stat = GetFileStat(filename)
+    if stat is None:
         return 0
     
-    return int(os.path.getmtime(filename))
+    return stat[0]
+
+def GetFileStat(filename): # return (mtime in ns, size) or None if the file does not exist
+    return statCache.Stat(filename)
+
+def ReadJSONFile(filename): # return None if the file is missing or unreadable
+    try:
+        with open(filename,'r') as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return None
+
+def WriteJSONFile(filename,data): # write to a temp file and rename so readers never see a partial file
+    d = os.path.dirname(filename)
+    if d and not os.path.exists(d):
+        MakePathSub(d)
+
+    tmp = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp,'w') as f:
+            json.dump(data,f,separators=(',',':'))
+        os.replace(tmp,filename)
+        statCache.Invalidate(filename)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def HashString(s):
+    return hashlib.blake2b(s.encode(),digest_size=16).hexdigest()
+
+def HashFile(filename):
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename,'rb') as f:
+        while True:
+            chunk = f.read(1<<16)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
 
 def MakePath(path): #path guaranteed does not exist
 	print(f'{TextColor(YELLOW)}Creating {path}{RESET()}')
@@ -65,6 +244,7 @@ def MakePathSub(path):
     if not os.path.exists(upper) and upper:
         MakePathSub(upper)
     os.mkdir(path)
+    statCache.Invalidate(path)
 
 def SortByFileTimesIP(files):
     files.sort(reverse=True,key=GetFileTime)
@@ -99,55 +279,1356 @@ def CPPExtractIncludeFile(line):
     return line[start+1:end]
     
 def CPPGetIncludePath(dep,includes):
-    for include in includes:
-        testPath = os.path.join(include,dep)
-        if os.path.exists(testPath):
-            return os.path.normpath(testPath)
-    
-    return ''
+    return GetIncludeResolver(includes).Resolve(dep)
 
-def CPPDeps(path,includeDirs):
+def CPPDeps(path,includeDirs,probes=None): # probes collects every directory an include was looked up in
     deps = set()
     prefix,filename = GetPrefixAndName(path)
+    resolver = GetIncludeResolver(includeDirs)
 
     with open(path,'r') as f:
         for line in f:
             line = line.lstrip(' \t')
-            if line[0]!='#':
+            if not line.startswith('#'):
                 continue
             line = line[1:].lstrip(' \t')
             if line.startswith('include') and '"' in line:
                 dep = CPPExtractQuoteIncludeFile(line)
-                test = os.path.join(prefix,dep)
-                if os.path.exists(test):
-                    deps.add(os.path.normpath(test))
+                test = resolver.Find(prefix,dep,probes)
+                if test != '':
+                    deps.add(test)
                     continue
-                test = CPPGetIncludePath(dep,includeDirs)
+                test = resolver.Resolve(dep,probes)
                 if test != '':
                     deps.add(test)
             elif line.startswith('include') and '<' in line:
                 dep = CPPExtractIncludeFile(line)
-                test = CPPGetIncludePath(dep,includeDirs)
+                test = resolver.Resolve(dep,probes)
                 if test != '':
                     deps.add(test)
     return deps
 
+# directives are found with a search for '#', the rest of the text is never looked at from Python.
+# Directive text stops where a comment starts.
+CPP_DIRECTIVE_PATTERN = re.compile(rb'\#[ \t]*(include(?:_next)?|if|ifdef|ifndef|elif|else|endif)\b((?:[^\n/]|/(?![*/]))*)')
+CPP_INCLUDE_NAME = re.compile(rb'[ \t]*(?:"([^"\n]*)"|<([^>\n]*)>)')
+
+def CPPCommentEnd(data,start,pos): # where the block comment around pos ends, 0 if there is none after start
+    opening = data.rfind(b'/*',start,pos)
+    while opening!=-1:
+        line = data[data.rfind(b'\n',0,opening)+1:opening]
+        # strings and line comments end with the line, so only a '/*' inside one on the same line is not a comment
+        if b'//' not in line and (line.count(b'"')-line.count(b'\\"')-line.count(b"'\"'"))%2==0:
+            closing = data.find(b'*/',opening+2)
+            if closing==-1:
+                return len(data)
+            return closing+2 if closing+2>pos else 0
+        opening = data.rfind(b'/*',start,opening)
+    return 0
+
+def CPPRegexDeps(path,includeDirs,probes=None): # like CPPDeps, but reads raw bytes and skips comments and #if 0 blocks
+    deps = set()
+    prefix = os.path.dirname(path)
+    resolver = GetIncludeResolver(includeDirs)
+
+    with open(path,'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        except ValueError: # empty files cannot be mapped
+            return deps
+
+    with data:
+        disabled = 0 # depth of #if nesting inside an #if 0 block
+        scanned = 0 # no block comment is open here, comments before it are already skipped
+        for match in CPP_DIRECTIVE_PATTERN.finditer(data):
+            start = match.start()
+            if start<scanned or data[data.rfind(b'\n',0,start)+1:start].strip(b' \t'):
+                continue
+            end = CPPCommentEnd(data,scanned,start)
+            scanned = end or start
+            if end:
+                continue
+
+            directive = match.group(1)
+            if disabled:
+                if directive.startswith(b'if'):
+                    disabled += 1
+                elif directive==b'endif':
+                    disabled -= 1
+                elif disabled==1 and directive in (b'else',b'elif'): # an #elif might be taken, so scan it
+                    disabled = 0
+            elif directive==b'if':
+                if match.group(2).strip()==b'0':
+                    disabled = 1
+            elif directive.startswith(b'include'):
+                name = CPP_INCLUDE_NAME.match(match.group(2))
+                if not name:
+                    continue
+                if name.group(1) is not None:
+                    dep = os.fsdecode(name.group(1))
+                    test = resolver.Find(prefix,dep,probes)
+                    if test != '':
+                        deps.add(test)
+                        continue
+                else:
+                    dep = os.fsdecode(name.group(2))
+                test = resolver.Resolve(dep,probes)
+                if test != '':
+                    deps.add(test)
+    return deps
+
+DEP_SCANNERS = {'lines':CPPDeps,'regex':CPPRegexDeps}
+
+DEP_CACHE_VERSION = 2
+MANIFEST_VERSION = 2
+COMMAND_HASH_VERSION = 1
+CONTENT_HASH_VERSION = 1
+DURATION_VERSION = 1
+OBJECT_CACHE_VERSION = 1
+LINK_INPUT_VERSION = 1
+UNITY_VERSION = 1
+LINK_PRIORITY = float('inf') # links are queued ahead of any compile, they finish a mode
+DEFAULT_COMPILE_RATE = 1e-5 # seconds per source byte, used until builder has seen some compiles
+
+def CondenseGraph(depdict): # Tarjan's algorithm, every component comes after the components it depends on
+    index = {}
+    lowlink = {}
+    onStack = set()
+    stack = []
+    components = []
+    componentOf = {}
+    counter = 0
+
+    for root in depdict:
+        if root in index:
+            continue
+        work = [(root,iter(depdict.get(root,())))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        onStack.add(root)
+        while work:
+            node,deps = work[-1]
+            descended = False
+            for dep in deps:
+                if dep not in index:
+                    index[dep] = lowlink[dep] = counter
+                    counter += 1
+                    stack.append(dep)
+                    onStack.add(dep)
+                    work.append((dep,iter(depdict.get(dep,()))))
+                    descended = True
+                    break
+                elif dep in onStack:
+                    lowlink[node] = min(lowlink[node],index[dep])
+            if descended:
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent],lowlink[node])
+            if lowlink[node]==index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    onStack.discard(member)
+                    componentOf[member] = len(components)
+                    component.append(member)
+                    if member==node:
+                        break
+                components.append(component)
+
+    return components,componentOf
+
+NO_IDS = array.array('i')
+COMPILER_LAUNCHERS = ('ccache','sccache','distcc','icecc','buildcache')
+CPP_SOURCE_EXTS = ('cpp','cc','cxx','c++','C','cp','CPP')
+
+class DepGraph: # the include graph with paths interned to ids, read and written like a dict of path -> set of paths
+    def __init__(self,paths=None,ids=None):
+        self.paths = [] if paths is None else paths # id -> path, shared with copies
+        self.ids = {} if ids is None else ids
+        # compressed rows (offsets,edges): edges[offsets[i]:offsets[i+1]] are the ids included by id i.
+        # One tuple, so threads reading during a scan never see offsets and edges from different compactions
+        self.rows = (array.array('q',[0]),NO_IDS)
+        self.changed = {} # id -> collection of paths, entries written since the last Compact, interned by it in bulk
+        self.present = bytearray() # 1 for ids that are keys of the graph
+        self.count = 0
+
+    def Intern(self,path):
+        i = self.ids.get(path)
+        if i is None:
+            i = len(self.paths)
+            self.ids[path] = i
+            self.paths.append(path)
+        return i
+
+    def Has(self,i):
+        return i<len(self.present) and self.present[i]==1
+
+    def Node(self,path): # graph walks work on nodes, ids here and paths in DictGraph
+        return self.ids.get(path)
+
+    def Path(self,i):
+        return self.paths[i]
+
+    def Deps(self,i):
+        deps = self.changed.get(i)
+        if deps is not None:
+            return tuple(map(self.Intern,deps))
+        offsets,edges = self.rows
+        if i+1<len(offsets):
+            return edges[offsets[i]:offsets[i+1]]
+        return NO_IDS
+
+    def Ids(self):
+        return (i for i,flag in enumerate(self.present) if flag)
+
+    def __setitem__(self,path,deps): # deps is kept as it is, callers hand over a set they no longer change
+        i = self.Intern(path)
+        self.changed[i] = deps
+        present = self.present
+        if i>=len(present): # grown ahead, ids past the last key read as absent
+            present.extend(bytes(max(i+1,len(present))))
+        if not present[i]:
+            present[i] = 1
+            self.count += 1
+
+    def __getitem__(self,path):
+        i = self.ids.get(path)
+        if i is None or not self.Has(i):
+            raise KeyError(path)
+        deps = self.changed.get(i)
+        if deps is not None:
+            return set(deps)
+        paths = self.paths
+        offsets,edges = self.rows
+        return {paths[dep] for dep in edges[offsets[i]:offsets[i+1]]}
+
+    def get(self,path,default=None):
+        try:
+            return self[path]
+        except KeyError:
+            return default
+
+    def pop(self,path,default=None):
+        deps = self.get(path)
+        if deps is None:
+            return default
+        i = self.ids[path]
+        self.present[i] = 0
+        self.changed[i] = ()
+        self.count -= 1
+        return deps
+
+    def __contains__(self,path):
+        i = self.ids.get(path)
+        return i is not None and self.Has(i)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        paths = self.paths
+        return (paths[i] for i in self.Ids())
+
+    def keys(self):
+        return iter(self)
+
+    def Copy(self): # the arrays are replaced rather than modified, so copies can share them
+        graph = DepGraph(self.paths,self.ids)
+        graph.rows = self.rows
+        graph.changed = dict(self.changed)
+        graph.present = bytearray(self.present)
+        graph.count = self.count
+        return graph
+
+    def Compact(self): # move the entries written since the last compaction into the arrays
+        changed = self.changed
+        if not changed and len(self.rows[0])==len(self.paths)+1:
+            return
+        if len(self.rows[0])==1: # the first compaction after a scan, every row is a set of paths
+            try: # a scan stores every file it finds included, so their paths are interned already
+                self.rows = self.InternRows(changed)
+            except KeyError: # an include that could not be read
+                self.InternMissing(changed)
+                self.rows = self.InternRows(changed)
+        else:
+            self.InternMissing(changed)
+            offsets = array.array('q',[0])
+            edges = array.array('i')
+            for i in range(len(self.paths)):
+                edges.extend(self.Deps(i))
+                offsets.append(len(edges))
+            self.rows = (offsets,edges)
+        self.changed = {}
+
+    def InternMissing(self,changed):
+        for dep in itertools.filterfalse(self.ids.__contains__,itertools.chain.from_iterable(changed.values())):
+            self.Intern(dep)
+
+    def InternRows(self,changed): # (offsets,edges) of every id, each path is looked up once in a single pass
+        count = len(self.paths)
+        rows = list(map(changed.get,range(count),itertools.repeat((),count)))
+        lengths = array.array('q',map(len,rows))
+        offsets = array.array('q',itertools.accumulate(lengths,initial=0))
+        return offsets,array.array('i',map(self.ids.__getitem__,itertools.chain.from_iterable(rows)))
+
+    def Condensed(self): # CondenseGraph over ids, with lists where it keeps dicts
+        self.Compact()
+        offsets,edges = self.rows
+        count = len(self.paths)
+        index = [-1]*count
+        lowlink = [0]*count
+        onStack = bytearray(count)
+        stack = []
+        components = []
+        componentOf = [0]*count
+        counter = 0
+
+        for root in self.Ids():
+            if index[root]>=0:
+                continue
+            work = [(root,iter(edges[offsets[root]:offsets[root+1]]))]
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            onStack[root] = 1
+            while work:
+                node,deps = work[-1]
+                descended = False
+                for dep in deps:
+                    if index[dep]<0:
+                        index[dep] = lowlink[dep] = counter
+                        counter += 1
+                        stack.append(dep)
+                        onStack[dep] = 1
+                        work.append((dep,iter(edges[offsets[dep]:offsets[dep+1]])))
+                        descended = True
+                        break
+                    elif onStack[dep] and index[dep]<lowlink[node]:
+                        lowlink[node] = index[dep]
+                if descended:
+                    continue
+
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if lowlink[node]<lowlink[parent]:
+                        lowlink[parent] = lowlink[node]
+                if lowlink[node]==index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        onStack[member] = 0
+                        componentOf[member] = len(components)
+                        component.append(member)
+                        if member==node:
+                            break
+                    components.append(component)
+
+        return components,componentOf
+
+    def Reachable(self,path): # path and every file it includes directly or indirectly
+        start = self.ids.get(path)
+        if start is None:
+            return {path}
+        # a set of ids rather than a bitset, most walks are much smaller than the graph
+        seen = {start}
+        stack = [start]
+        while stack:
+            for dep in self.Deps(stack.pop()):
+                if dep not in seen:
+                    seen.add(dep)
+                    stack.append(dep)
+        paths = self.paths
+        return {paths[i] for i in seen}
+
+class DictGraph(dict): # the include graph as path -> set of paths, builds faster than DepGraph but takes more memory
+    def Node(self,path):
+        return path
+
+    def Path(self,path):
+        return path
+
+    def Deps(self,path):
+        return self.get(path,())
+
+    def Compact(self):
+        pass
+
+    def Copy(self): # entries are replaced rather than modified, so copies can share the sets
+        return DictGraph(self)
+
+    def Condensed(self):
+        return CondenseGraph(self)
+
+    def Reachable(self,path): # path and every file it includes directly or indirectly
+        seen = {path}
+        stack = [path]
+        while stack:
+            for dep in self.get(stack.pop(),()):
+                if dep not in seen:
+                    seen.add(dep)
+                    stack.append(dep)
+        return seen
+
+def ScanFile(extractFunc,path,includeDirs): # runs inside scan workers
+    stat = GetFileStat(path)
+    if stat is None:
+        return path,None,None,None
+    probes = set()
+    return path,stat,extractFunc(path,includeDirs,probes),probes
+
+class DepCache: # persistent map of file -> dependencies, keyed by path, mtime and size, and the mtimes of the directories its includes were looked up in
+    def __init__(self,path,key):
+        self.path = path
+        self.key = key
+        self.entries = {}
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+
+    def Load(self):
+        data = ReadJSONFile(self.path)
+        if type(data) is not dict:
+            return
+        if data.get('version')!=DEP_CACHE_VERSION or data.get('key')!=self.key:
+            return
+
+        files = data.get('files')
+        if type(files) is dict:
+            self.entries = files
+
+    def Lookup(self,path,stat):
+        entry = self.entries.get(path)
+        try:
+            # a header created or removed in a probed directory can change what an include resolves to
+            if entry is not None and entry[0]==stat[0] and entry[1]==stat[1] and all(GetFileTime(d)==t for d,t in entry[3]):
+                deps = set(entry[2])
+                self.used[path] = entry
+                self.hits += 1
+                return deps
+        except (TypeError,IndexError,KeyError):
+            pass
+
+        self.misses += 1
+        return None
+
+    def Store(self,path,stat,deps,probes):
+        self.used[path] = [stat[0],stat[1],sorted(deps),[[d,GetFileTime(d)] for d in sorted(probes)]]
+        self.dirty = True
+
+    def Save(self,partial=False): # a partial scan only looked up the files it rescanned, the others are kept
+        # after a full scan, entries that were not looked up belong to deleted files
+        if not self.dirty and (partial or len(self.used)==len(self.entries)):
+            return
+
+        files = {**self.entries,**self.used} if partial else self.used
+        data = {'version':DEP_CACHE_VERSION,'key':self.key,'files':files}
+        WriteJSONFile(self.path,data)
+        self.entries = files
+        self.used = {}
+        self.dirty = False
+
+class CommandHashes: # hash of the last command that successfully produced each output
+    def __init__(self,path):
+        self.path = path
+        self.hashes = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def Load(self):
+        data = ReadJSONFile(self.path)
+        if type(data) is not dict or data.get('version')!=COMMAND_HASH_VERSION:
+            return
+
+        hashes = data.get('outputs')
+        if type(hashes) is dict:
+            self.hashes = hashes
+
+    def Changed(self,output,cmd):
+        return self.hashes.get(output)!=HashString(CommandString(cmd))
+
+    def Update(self,output,cmd):
+        with self.lock:
+            self.hashes[output] = HashString(CommandString(cmd))
+            self.dirty = True
+
+    def Save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {'version':COMMAND_HASH_VERSION,'outputs':dict(self.hashes)}
+            self.dirty = False
+        WriteJSONFile(self.path,data)
+
+class ContentHashes: # content hash of every input, and the combined input hash each object was built from
+    def __init__(self,path):
+        self.path = path
+        self.files = {}
+        self.objects = {}
+        self.hashes = {}
+        self.hashed = 0
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def Load(self):
+        data = ReadJSONFile(self.path)
+        if type(data) is not dict or data.get('version')!=CONTENT_HASH_VERSION:
+            return
+
+        files = data.get('files')
+        objects = data.get('objects')
+        if type(files) is dict and type(objects) is dict:
+            self.files = files
+            self.objects = objects
+
+    def GetHash(self,path): # mtime and size are only a pre-filter, unchanged entries skip rehashing
+        if path in self.hashes:
+            return self.hashes[path]
+
+        stat = GetFileStat(path)
+        if stat is None:
+            return ''
+
+        entry = self.files.get(path)
+        if type(entry) is list and len(entry)==3 and entry[0]==stat[0] and entry[1]==stat[1]:
+            h = entry[2]
+        else:
+            h = HashFile(path)
+            self.files[path] = [stat[0],stat[1],h]
+            self.hashed += 1
+            self.dirty = True
+
+        self.hashes[path] = h
+        return h
+
+    def Changed(self,obj,signature):
+        return self.objects.get(obj)!=signature
+
+    def Update(self,obj,signature):
+        with self.lock:
+            self.objects[obj] = signature
+            self.dirty = True
+
+    def Save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {'version':CONTENT_HASH_VERSION,'files':dict(self.files),'objects':dict(self.objects)}
+            self.dirty = False
+        WriteJSONFile(self.path,data)
+
+class LinkInputs: # the objects each output was last linked from, hashed for restat
+    def __init__(self,path):
+        self.path = path
+        self.outputs = {}
+        self.dirty = False
+
+    def Load(self):
+        data = ReadJSONFile(self.path)
+        if type(data) is not dict or data.get('version')!=LINK_INPUT_VERSION:
+            return
+
+        outputs = data.get('outputs')
+        if type(outputs) is dict:
+            self.outputs = outputs
+
+    def Unchanged(self,output,obj,stat): # True if obj holds the same bytes it had at the last link
+        entries = self.outputs.get(output)
+        entry = entries.get(obj) if type(entries) is dict else None
+        if type(entry) is not list or len(entry)!=3 or entry[1]!=stat[1]:
+            return False
+        if entry[0]==stat[0]:
+            return True
+        if HashFile(obj)!=entry[2]:
+            return False
+        entry[0] = stat[0] # the next build can trust the mtime again
+        self.dirty = True
+        return True
+
+    def Update(self,output,objs):
+        old = self.outputs.get(output)
+        if type(old) is not dict:
+            old = {}
+        entries = {}
+        for obj in objs:
+            stat = GetFileStat(obj)
+            if stat is None:
+                continue
+            entry = old.get(obj)
+            if type(entry) is list and len(entry)==3 and entry[0]==stat[0] and entry[1]==stat[1]:
+                entries[obj] = entry
+            else:
+                entries[obj] = [stat[0],stat[1],HashFile(obj)]
+        self.outputs[output] = entries
+        self.dirty = True
+
+    def Save(self):
+        if not self.dirty:
+            return
+        WriteJSONFile(self.path,{'version':LINK_INPUT_VERSION,'outputs':self.outputs})
+        self.dirty = False
+
+SHELL_SYNTAX = re.compile(r'[|&;<>()$`*?\[~\n]')
+SHELL_ASSIGNMENT = re.compile(r'[A-Za-z_][A-Za-z0-9_]*=')
+
+def SplitFlag(flag): # a literal flag can hold several arguments, quoted like in a shell
+    if os.name=='posix':
+        return shlex.split(flag)
+    return flag.split()
+
+def JoinArgs(args):
+    if os.name=='posix':
+        return shlex.join(args)
+    return subprocess.list2cmdline(args)
+
+def CommandString(cmd): # commands are argv lists, or strings that run through the shell
+    return cmd if type(cmd) is str else JoinArgs(cmd)
+
+def NeedsShell(args): # pipes, redirections, globs, variables and VAR=value prefixes
+    if args and SHELL_ASSIGNMENT.match(args[0]):
+        return True
+    return any(SHELL_SYNTAX.search(arg) for arg in args)
+
+def StartProcess(cmd,newSession=False): # argv lists skip the shell, strings go through it
+    newSession = newSession and os.name=='posix'
+    if type(cmd) is list:
+        try:
+            # CPython spawns with vfork here, as cheap as posix_spawn
+            return subprocess.Popen(cmd,stdout=sys.stdout,stderr=sys.stderr,start_new_session=newSession)
+        except OSError: # shell builtins, or let the shell report a command that cannot be run
+            cmd = JoinArgs(cmd)
+    return subprocess.Popen(cmd,stdout=sys.stdout,stderr=sys.stderr,shell=True,start_new_session=newSession)
+
+def KillProcess(p):
+    try:
+        if os.name=='posix':
+            os.killpg(p.pid,signal.SIGTERM)
+        else:
+            p.terminate()
+    except OSError:
+        pass
+
+class CompileDurations: # how long each object took to compile, smoothed over builds
+    def __init__(self,path):
+        self.path = path
+        self.durations = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def Load(self):
+        data = ReadJSONFile(self.path)
+        if type(data) is not dict or data.get('version')!=DURATION_VERSION:
+            return
+
+        durations = data.get('objects')
+        if type(durations) is dict:
+            self.durations = durations
+
+    def Get(self,obj):
+        d = self.durations.get(obj)
+        if type(d) in (int,float):
+            return d
+        return None
+
+    def Update(self,obj,seconds):
+        with self.lock:
+            old = self.Get(obj)
+            self.durations[obj] = seconds if old is None else (old+seconds)/2
+            self.dirty = True
+
+    def Save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {'version':DURATION_VERSION,'objects':dict(self.durations)}
+            self.dirty = False
+        WriteJSONFile(self.path,data)
+
+def GetDefaultCacheDir():
+    if GetPlatform()=='windows' and 'LOCALAPPDATA' in os.environ:
+        return os.path.join(os.environ['LOCALAPPDATA'],'builder','cache')
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'),'.cache')
+    return os.path.join(base,'builder')
+
+class ObjectCache: # content addressed objects shared between modes, branches and projects
+    def __init__(self,path,maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.inserted = 0
+        self.lock = threading.Lock()
+
+    def GetEntryPath(self,key):
+        return os.path.join(self.path,f'v{OBJECT_CACHE_VERSION}',key[:2],key)
+
+    def Restore(self,key,obj):
+        entry = self.GetEntryPath(key)
+        tmp = f'{obj}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            shutil.copyfile(entry,tmp)
+            os.replace(tmp,obj)
+            os.utime(entry) # entries are evicted least recently used first
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            with self.lock:
+                self.misses += 1
+            return False
+
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def Insert(self,key,obj): # copy then rename, so concurrent builders never see a partial entry
+        entry = self.GetEntryPath(key)
+        tmp = f'{entry}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(entry),exist_ok=True)
+            shutil.copyfile(obj,tmp)
+            os.replace(tmp,entry)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        with self.lock:
+            self.inserted += 1
+
+    def GetEntries(self):
+        entries = []
+        root = os.path.join(self.path,f'v{OBJECT_CACHE_VERSION}')
+        if not os.path.isdir(root):
+            return entries
+        for d in os.scandir(root):
+            if not d.is_dir():
+                continue
+            for entry in os.scandir(d.path):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns,st.st_size,entry.path))
+        return entries
+
+    def Evict(self): # drop least recently used entries until the cache is below 90% of its size limit
+        if self.inserted==0:
+            return 0
+        entries = self.GetEntries()
+        total = sum(size for mtime,size,path in entries)
+        if total<=self.maxSize:
+            return 0
+
+        removed = 0
+        entries.sort()
+        for mtime,size,path in entries:
+            if total<=self.maxSize*0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def GetStatsPath(self):
+        return os.path.join(self.path,'stats.json')
+
+    def LoadStats(self):
+        stats = ReadJSONFile(self.GetStatsPath())
+        if type(stats) is not dict:
+            stats = {}
+        return {'hits':stats.get('hits',0),'misses':stats.get('misses',0)}
+
+    def SaveStats(self):
+        if self.hits==0 and self.misses==0:
+            return
+        stats = self.LoadStats()
+        stats['hits'] += self.hits
+        stats['misses'] += self.misses
+        WriteJSONFile(self.GetStatsPath(),stats)
+
+def PredictMakespan(costs,workers): # simulate longest-processing-time-first on the given number of workers
+    loads = [0.0]*max(1,workers)
+    for cost in sorted(costs,reverse=True):
+        heapq.heapreplace(loads,loads[0]+cost)
+    return max(loads)
+
+class JobScheduler: # runs jobs on worker threads, highest priority first, cancelling everything on failure
+    def __init__(self,workers,keepGoing=False):
+        self.keepGoing = keepGoing
+        self.cond = threading.Condition()
+        self.pending = []
+        self.counter = 0
+        self.running = 0
+        self.closed = False
+        self.cancelled = False
+        self.failures = 0
+        self.processes = set()
+        self.local = threading.local()
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.Worker,name=str(i+1),daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def Submit(self,func,args=(),priority=0): # func returns True on success
+        with self.cond:
+            if self.cancelled:
+                return
+            heapq.heappush(self.pending,(-priority,self.counter,time.perf_counter(),func,args))
+            self.counter += 1
+            self.cond.notify()
+
+    def Worker(self):
+        while True:
+            with self.cond:
+                # a running job may still submit more, such as the link waiting on it
+                while not self.pending and not self.cancelled and (not self.closed or self.running):
+                    self.cond.wait()
+                if self.cancelled or not self.pending:
+                    return
+                _,_,submitted,func,args = heapq.heappop(self.pending)
+                self.running += 1
+            self.local.queueWait = time.perf_counter()-submitted
+
+            ok = False
+            try:
+                ok = func(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.cond:
+                    self.running -= 1
+                    if not ok:
+                        self.failures += 1
+                        if not self.keepGoing:
+                            self.CancelLocked()
+                    self.cond.notify_all()
+
+    def RunProcess(self,cmd): # like Builder.RunCommand, but killed when the scheduler is cancelled
+        if self.IsCancelled():
+            return -1
+        # a process group per job lets cancellation reach everything the compiler started
+        p = StartProcess(cmd,True)
+        with self.cond:
+            self.processes.add(p)
+            if self.cancelled:
+                KillProcess(p)
+        code = p.wait()
+        with self.cond:
+            self.processes.discard(p)
+        return code
+
+    def GetQueueWait(self): # seconds the job on the calling worker spent queued
+        return getattr(self.local,'queueWait',0)
+
+    def IsCancelled(self):
+        with self.cond:
+            return self.cancelled
+
+    def Cancel(self):
+        with self.cond:
+            self.CancelLocked()
+            self.cond.notify_all()
+
+    def CancelLocked(self):
+        self.cancelled = True
+        self.pending = []
+        for p in self.processes:
+            KillProcess(p)
+
+    def Wait(self): # close the queue and wait for every job, return True if none failed
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        try:
+            with self.cond:
+                while self.running or (self.pending and not self.cancelled):
+                    self.cond.wait()
+        except KeyboardInterrupt:
+            self.Cancel()
+            raise
+        return self.failures==0
+
+WATCH_DEBOUNCE = 0.05 # seconds without new changes before a burst of changes is handled
+WATCH_POLL_INTERVAL = 0.25
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = IN_MODIFY|IN_ATTRIB|IN_CLOSE_WRITE|IN_MOVED_FROM|IN_MOVED_TO|IN_CREATE|IN_DELETE
+
+def IsInDirs(path,dirs): # dirs must be normalized
+    path = os.path.normpath(path)
+    for d in dirs:
+        if path==d or path.startswith(d+os.sep):
+            return True
+    return False
+
+def ListFilesRecursive(d):
+    files = []
+    for root,dirs,names in os.walk(d):
+        files.extend(os.path.join(root,name) for name in names)
+    return files
+
+class InotifyWatcher: # Linux, the kernel reports changes so nothing is rescanned while idle
+    def __init__(self,ignore):
+        libc = ctypes.CDLL(None,use_errno=True)
+        self.addWatch = libc.inotify_add_watch
+        self.addWatch.argtypes = [ctypes.c_int,ctypes.c_char_p,ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd<0:
+            raise OSError(ctypes.get_errno(),'inotify_init1 failed')
+        self.ignore = ignore
+        self.added = set()
+        self.watched = set()
+        self.watches = {}
+        self.overflowed = False
+
+    def AddDir(self,d,recursive=True):
+        if (d,recursive) in self.added or IsInDirs(d,self.ignore):
+            return
+        self.added.add((d,recursive))
+        key = (os.path.realpath(d),recursive) # symlinked dirs are only watched once
+        if key in self.watched:
+            return
+        wd = self.addWatch(self.fd,os.fsencode(d),INOTIFY_MASK)
+        if wd<0: # the dir is gone, or the watch limit is reached
+            return
+        self.watched.add(key)
+        self.watches[wd] = (d,recursive,key)
+        if recursive:
+            try:
+                with os.scandir(d) as it:
+                    subdirs = [os.path.join(d,entry.name) for entry in it if entry.is_dir()]
+            except OSError:
+                return
+            for sub in subdirs:
+                self.AddDir(sub)
+
+    def Read(self,timeout): # return the paths named by pending events, None if nothing arrived in time
+        ready,_,_ = select.select([self.fd],[],[],timeout)
+        if not ready:
+            return None
+        data = os.read(self.fd,65536)
+        changed = set()
+        pos = 0
+        while pos<len(data):
+            wd,mask,cookie,length = struct.unpack_from('iIII',data,pos)
+            pos += 16
+            name = os.fsdecode(data[pos:pos+length].rstrip(b'\0'))
+            pos += length
+            if mask&IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            watch = self.watches.get(wd)
+            if watch is None:
+                continue
+            d,recursive,key = watch
+            if mask&IN_IGNORED:
+                del self.watches[wd]
+                self.watched.discard(key)
+                self.added.discard((d,recursive))
+                continue
+            path = os.path.join(d,name) if name else d
+            if IsInDirs(path,self.ignore):
+                continue
+            if mask&IN_ISDIR and mask&(IN_CREATE|IN_MOVED_TO) and recursive:
+                self.AddDir(path)
+                # files can land in a new dir before its watch exists
+                changed.update(ListFilesRecursive(path))
+            changed.add(path)
+        return changed
+
+    def Wait(self): # block until a burst of changes is over, None means events were lost
+        changed = set()
+        while not changed and not self.overflowed:
+            changed |= self.Read(None) or set()
+        while True:
+            more = self.Read(WATCH_DEBOUNCE)
+            if more is None:
+                break
+            changed |= more
+
+        if self.overflowed:
+            self.overflowed = False
+            return None
+        return changed
+
+    def Drain(self): # changes seen since the last call, without waiting
+        changed = set()
+        while True:
+            more = self.Read(0)
+            if more is None:
+                break
+            changed |= more
+
+        if self.overflowed:
+            self.overflowed = False
+            return None
+        return changed
+
+    def Close(self):
+        os.close(self.fd)
+
+class PollWatcher: # portable fallback, compares directory snapshots
+    def __init__(self,ignore):
+        self.ignore = ignore
+        self.dirs = []
+        self.snapshot = {}
+
+    def AddDir(self,d,recursive=True):
+        if (d,recursive) in self.dirs or IsInDirs(d,self.ignore):
+            return
+        self.dirs.append((d,recursive))
+        self.snapshot.update(self.Snapshot([(d,recursive)]))
+
+    def Snapshot(self,dirs):
+        snapshot = {}
+        stack = list(dirs)
+        while stack:
+            d,recursive = stack.pop()
+            try:
+                with os.scandir(d) as it:
+                    for entry in it:
+                        path = os.path.join(d,entry.name)
+                        if IsInDirs(path,self.ignore):
+                            continue
+                        try:
+                            if recursive and entry.is_dir():
+                                stack.append((path,True))
+                            st = entry.stat()
+                            snapshot[path] = (st.st_mtime_ns,st.st_size)
+                        except OSError:
+                            pass
+            except OSError:
+                pass
+        return snapshot
+
+    def Poll(self):
+        new = self.Snapshot(self.dirs)
+        changed = {path for path,stat in new.items() if self.snapshot.get(path)!=stat}
+        changed.update(path for path in self.snapshot if path not in new)
+        self.snapshot = new
+        return changed
+
+    def Wait(self): # block until a burst of changes is over
+        changed = set()
+        while not changed:
+            time.sleep(WATCH_POLL_INTERVAL)
+            changed = self.Poll()
+        while True:
+            time.sleep(WATCH_DEBOUNCE)
+            more = self.Poll()
+            if not more:
+                return changed
+            changed |= more
+
+    def Drain(self):
+        return self.Poll()
+
+    def Close(self):
+        pass
+
+def OpenWatcher(ignore): # inotify where the platform has it, polling everywhere else
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(ignore)
+        except (OSError,AttributeError):
+            pass
+    return PollWatcher(ignore)
+
+class TraceSpan: # records one span when it ends, args can still be filled in before that
+    def __init__(self,tracer,name,cat,args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        if self.tracer:
+            self.start = self.tracer.Now()
+        return self
+
+    def __exit__(self,*exc):
+        if self.tracer:
+            self.tracer.Add(self.name,self.cat,self.start,self.tracer.Now(),self.args)
+        return False
+
+class Tracer: # Chrome trace events for --trace, open the file in Perfetto or chrome://tracing
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.lanes = {}
+        self.lock = threading.Lock()
+
+    def Now(self): # microseconds since the trace started
+        return (time.perf_counter()-self.start)*1e6
+
+    def GetLane(self): # compile workers keep their lane across dispatches since they share names
+        name = threading.current_thread().name
+        lane = self.lanes.get(name)
+        if lane is None:
+            lane = len(self.lanes)
+            self.lanes[name] = lane
+        return lane
+
+    def Add(self,name,cat,start,end,args=None):
+        event = {'name':name,'cat':cat,'ph':'X','ts':round(start,1),'dur':round(end-start,1),'pid':self.pid}
+        if args:
+            event['args'] = args
+        with self.lock:
+            event['tid'] = self.GetLane()
+            self.events.append(event)
+
+    def Write(self,path):
+        events = [{'name':'process_name','ph':'M','pid':self.pid,'tid':0,'args':{'name':'builder'}}]
+        for name,lane in self.lanes.items():
+            label = 'builder' if name=='MainThread' else f'worker {name}'
+            events.append({'name':'thread_name','ph':'M','pid':self.pid,'tid':lane,'args':{'name':label}})
+            events.append({'name':'thread_sort_index','ph':'M','pid':self.pid,'tid':lane,'args':{'sort_index':lane}})
+        WriteJSONFile(path,{'traceEvents':events+self.events,'displayTimeUnit':'ms'})
+
+TARGET_COMMANDS = {'executable':'linkCmd','static':'archiveCmd','shared':'sharedCmd'}
+TARGET_ACTIONS = {'executable':'Linking executable','static':'Archiving','shared':'Linking shared library'}
+
+class Target: # one output of a mode, built from its own sources and the outputs it links against
+    def __init__(self,name,kind,output,patterns,deps):
+        self.name = name
+        self.kind = kind
+        self.output = output
+        self.patterns = patterns
+        self.deps = deps # names, replaced by targets once every target is known
+        self.linkDeps = [] # targets whose outputs are link inputs, dependents before their deps
+        self.dependents = []
+        self.pic = kind=='shared'
+        self.Reset()
+
+    def Reset(self):
+        self.sources = []
+        self.pending = len(self.linkDeps) # objects and link inputs not done yet
+        self.failed = False
+        self.queued = False
+        self.built = None
+
+    def Matches(self,src): # glob, or a directory holding the source
+        path = os.path.normpath(src)
+        for pattern in self.patterns:
+            if fnmatch.fnmatchcase(path,pattern) or path.startswith(pattern+os.path.sep):
+                return True
+        return False
+
+IN_SLOT = '\0in\0'
+OUT_SLOT = '\0out\0'
+
+class CompiledMode: # everything a mode resolves to, computed once so per-file work is a substitution
+    def __init__(self,builder,mode):
+        options = builder.options
+        self.builder = builder
+        self.mode = mode
+        self.vars = {}
+        for d in [options]+[GetModeDict(options,mode[:i+1]) for i in range(len(mode))]:
+            for name in d:
+                if name!='modes':
+                    self.vars[name] = GetModeVar(options,mode,name)
+
+        self.srcExts = self.vars['srcExts']
+        self.headerExts = self.vars['headerExts']
+        self.objExt = self.vars['objExt']
+        self.objDir = builder.GetPath(mode,'objDir')
+        self.outputPath = os.path.join(builder.GetPath(mode,'outputDir'),self.vars['outputName'])
+        self.includeDirs = builder.GetPaths(mode,'includeDirs')
+        self.compileTemplate = None # commands are only resolved once they are needed
+        self.compileSlots = []
+        self.stepTemplates = {}
+        self.extraArgs = {} # per source arguments, such as the PIC flag for shared targets
+        self.targets = None
+        self.pchHeader = builder.GetStatePath(mode,'pch.h')
+        self.pchOutput = None
+        self.pchArgs = None
+
+    def Var(self,name):
+        return self.vars.get(name)
+
+    def GetObject(self,src):
+        return os.path.join(self.objDir,src+'.'+self.objExt)
+
+    def GetCompileTemplate(self):
+        if self.compileTemplate is None:
+            self.compileTemplate = self.builder.ResolveCompileArgs(self.mode,IN_SLOT,OUT_SLOT)
+            if NeedsShell(self.compileTemplate):
+                self.compileTemplate = self.builder.ResolveCompileCommand(self.mode,IN_SLOT,OUT_SLOT)
+            else:
+                self.compileSlots = [i for i,arg in enumerate(self.compileTemplate) if '\0' in arg]
+        return self.compileTemplate
+
+    def GetCompiler(self): # the compiler's name without target prefix, version or launchers such as ccache
+        template = self.GetCompileTemplate()
+        if type(template) is str:
+            template = template.split()
+        for arg in template:
+            if re.match(r'\w+=',arg): # environment assignments such as CCACHE_DIR=...
+                continue
+            name = os.path.basename(arg)
+            if name.lower().endswith('.exe'):
+                name = name[:-4]
+            if name in COMPILER_LAUNCHERS:
+                continue
+            name = re.sub(r'-[\d.]+$','',name) # g++-12
+            return name.rsplit('-',1)[-1] # x86_64-linux-gnu-gcc
+        return ''
+
+    def GetPchStyle(self): # 'gcc', 'clang' or None if the compiler has no known PCH flags
+        compiler = self.GetCompiler()
+        if compiler in ('clang','clang++'):
+            return 'clang'
+        if compiler in ('gcc','g++','cc','c++'):
+            return 'gcc'
+        return None
+
+    def GetPchLanguage(self): # the compiler decides, a C compiler driver goes by the source extensions
+        if '++' in self.GetCompiler() or any(ext in CPP_SOURCE_EXTS for ext in self.srcExts):
+            return 'c++-header'
+        return 'c-header'
+
+    def GetPchArgs(self): # added to every source without arguments of its own
+        if self.pchArgs is None:
+            self.pchArgs = []
+            style = self.GetPchStyle() if self.vars.get('pch') and self.vars.get('compileCmd') else None
+            if style:
+                self.pchOutput = self.pchHeader+('.pch' if style=='clang' else '.gch')
+            if style=='gcc':
+                self.pchArgs = ['-include',self.pchHeader] # gcc picks up pchHeader.gch next to it
+            elif style=='clang':
+                self.pchArgs = ['-include-pch',self.pchOutput]
+        return self.pchArgs
+
+    def GetPchCommand(self): # the compile command, with the generated header as a header input
+        self.GetPchArgs()
+        lang = self.GetPchLanguage()
+        template = self.GetCompileTemplate()
+        if type(template) is str:
+            return template.replace(IN_SLOT,f'-x {lang} {self.pchHeader}').replace(OUT_SLOT,self.pchOutput)
+        cmd = []
+        for arg in template:
+            if arg==IN_SLOT:
+                cmd += ['-x',lang]
+            cmd.append(arg.replace(IN_SLOT,self.pchHeader).replace(OUT_SLOT,self.pchOutput))
+        return cmd
+
+    def GetCompileCommand(self,src,obj):
+        self.GetCompileTemplate()
+        extra = self.extraArgs.get(src)
+        if extra is None:
+            extra = self.GetPchArgs()
+        if type(self.compileTemplate) is str:
+            cmd = self.compileTemplate.replace(IN_SLOT,src).replace(OUT_SLOT,obj)
+            return cmd+' '+JoinArgs(extra) if extra else cmd
+        cmd = list(self.compileTemplate)
+        for i in self.compileSlots:
+            cmd[i] = cmd[i].replace(IN_SLOT,src).replace(OUT_SLOT,obj)
+        if extra:
+            cmd.extend(extra)
+        return cmd
+
+    def GetLinkCommand(self,inputs,output): # inputs is a list of objects
+        return self.GetStepCommand('linkCmd',inputs,output)
+
+    def GetTargetCommand(self,target,inputs):
+        return self.GetStepCommand(TARGET_COMMANDS[target.kind],inputs,target.output)
+
+    def GetStepCommand(self,name,inputs,output): # a command over many inputs, like linkCmd or archiveCmd
+        template = self.stepTemplates.get(name)
+        if template is None:
+            template = self.builder.GetCommandArgs(self.mode,name,IN_SLOT,OUT_SLOT)
+            if NeedsShell(template):
+                template = self.builder.GetCommand(self.mode,name,IN_SLOT,OUT_SLOT)
+            self.stepTemplates[name] = template
+
+        if type(template) is str:
+            return template.replace(IN_SLOT,' '.join(inputs)).replace(OUT_SLOT,output)
+        cmd = []
+        for arg in template:
+            if arg==IN_SLOT:
+                cmd.extend(inputs)
+            else:
+                cmd.append(arg.replace(IN_SLOT,' '.join(inputs)).replace(OUT_SLOT,output))
+        return cmd
+
+    def GetCommandsHash(self): # flags such as %utime resolve differently between runs, which changes this hash
+        templates = []
+        if self.vars.get('compileCmd'):
+            templates.append(self.GetCompileTemplate())
+            templates.append(self.GetPchArgs()) # with the PIC flag, all a per-object command adds to the template
+            templates.append(SplitFlag(self.vars.get('picFlag') or ''))
+        steps = {TARGET_COMMANDS[target.kind] for target in self.GetTargets()} if self.vars.get('targets') else set()
+        if not steps and self.vars.get('linkCmd'):
+            steps.add('linkCmd')
+        for name in sorted(steps):
+            templates.append(self.GetStepCommand(name,[],''))
+        return HashString('\n'.join(CommandString(template) for template in templates))
+
+    def GetTargets(self): # parsed once per mode, every target comes after its deps
+        if self.targets is None:
+            self.targets = self.builder.ParseTargets(self.mode,self.vars.get('targets') or {})
+        return self.targets
+
 class Builder:
     def __init__(self,options):
         self.options = options
         self.TestDirs([],self.options['modes'])
         
         self.depExtractFunc = None
-        self.depdict = {}
-        self.invdict = {}
+        self.compiledModes = {}
+        self.depCache = None
+        self.commandHashes = None
+        self.durations = None
+        self.estimates = {}
+        self.contentHashes = None
+        self.objCache = None
+        self.cacheKeys = {}
+        self.compilerStamps = {}
+        self.compileCommands = {}
+        self.signatures = {}
+        self.depdict = DictGraph()
         self.compileFiles = set()
+        self.scannedDirs = set()
         self.rebuildList = []
+        self.removedSources = False
+        self.targets = []
+        self.targetOf = {}
+        self.linkInputs = None
+        self.pchHeaders = []
+        self.unityBatches = {}
+        self.batchOf = {}
+        self.unityMembers = {}
+        self.builderFile = None
         self.debug = False
         self.quiet = False
         self.single = False
+        self.jobs = 0
+        self.keepGoing = False
+        self.scheduler = None
+        self.scanning = False # early compiles run while the graph is still being filled
+        self.tracer = None
+        self.workerAddresses = []
+        self.remote = None
 
-        self.commandFailed = False
-        self.failLock = threading.Lock()
         self.printLock = threading.Lock()
         self.dispatchLock = threading.Lock()
         self.pathLock = threading.Lock()
@@ -164,13 +1645,22 @@ class Builder:
         with self.printLock:
             self.InfoPrint(msg,end)
     
+    def Trace(self,name,cat='phase',**args): # a no-op span unless --trace is on
+        return TraceSpan(self.tracer,name,cat,args)
+
+    def GetCompiledMode(self,mode):
+        key = tuple(mode)
+        compiled = self.compiledModes.get(key)
+        if compiled is None:
+            compiled = CompiledMode(self,mode)
+            self.compiledModes[key] = compiled
+        return compiled
+
     def GetSourceExts(self,mode):
-        exts = GetModeVar(self.options,mode,'srcExts')
-        return exts
+        return self.GetCompiledMode(mode).srcExts
     
     def GetHeaderExts(self,mode):
-        exts = GetModeVar(self.options,mode,'headerExts')
-        return exts
+        return self.GetCompiledMode(mode).headerExts
 
     def RemoveObjects(self,path,ext):
         l = os.listdir(path)
@@ -181,16 +1671,16 @@ class Builder:
             elif os.path.isfile(p):
                 if GetExtension(f)==ext:
                     os.remove(p)
+                    statCache.Invalidate(p)
                     self.DebugPrint(f"{TextColor(MAGENTA)}Deleting {p}...{RESET()}")
 		
     def DirContainsObjectsSub(self,path,ext):
-        l = os.listdir(path)
-        for f in l:
+        for f,isDir,isFile in statCache.ListDir(path):
             p = os.path.join(path,f)
-            if os.path.isdir(p):
+            if isDir:
                 if self.DirContainsObjectsSub(p,ext):
                     return True
-            elif os.path.isfile(p):
+            elif isFile:
                 if GetExtension(f)==ext:
                     return True
 
@@ -200,135 +1690,353 @@ class Builder:
         path = self.GetPath(mode,'objDir')
         ext = GetModeVar(self.options,mode,'objExt')
         
-        if not os.path.exists(path):
+        if not statCache.Exists(path):
             return False
         
         return self.DirContainsObjectsSub(path,ext)
 
     def FindFileDependencies(self,path,includeDirs):
-        if not os.path.exists(path):
+        stat = GetFileStat(path)
+        if stat is None:
             return
-		
-        deps = self.depExtractFunc(path,includeDirs)
+
+        deps = None
+        if self.depCache:
+            deps = self.depCache.Lookup(path,stat)
+        if deps is None:
+            probes = set()
+            deps = self.depExtractFunc(path,includeDirs,probes)
+            if self.depCache:
+                self.depCache.Store(path,stat,deps,probes)
+
         self.depdict[path] = deps
         for d in deps:
             if d not in self.depdict: #if dependency not tracked, add it and recursively search for more deps
                 self.FindFileDependencies(d,includeDirs)
     
-    def InvertDependencies(self):
-        self.invdict = {}
-        for file in self.depdict:
-            for dep in self.depdict[file]:
-                if dep not in self.invdict:
-                    self.invdict[dep] = set()
-                self.invdict[dep].add(file)
-        return self.invdict
-
-    def HeaderFileCascade(self,mode,headerFile,cascadeSet=None,checkedHeadersSet=None): #return all source files affected by a header file
-        if cascadeSet is None:
-            cascadeSet = set()
-            checkedHeadersSet = set()
-
-        children = self.invdict[headerFile]
-        sourceExts = self.GetSourceExts(mode)
-        headerExts = self.GetHeaderExts(mode)
-
-        for child in children:
-            if GetExtension(child) in sourceExts:
-                cascadeSet.add(child)
-            elif GetExtension(child) in headerExts:
-                if child not in checkedHeadersSet:
-                    checkedHeadersSet.add(child)
-                    cascadeSet = self.HeaderFileCascade(mode,child,cascadeSet,checkedHeadersSet)
-
-        return cascadeSet
-        
-    def CollectCompilables(self,srcDir,srcExts,includeDirs):
-        files = os.listdir(srcDir)
-        for file in files:
+    def GetTransitiveDeps(self,path): # return path and every file it includes directly or indirectly
+        return self.depdict.Reachable(path)
+
+    def CollectCompilables(self,srcDir,srcExts):
+        self.scannedDirs.add(srcDir)
+        for file,isDir,isFile in statCache.ListDir(srcDir):
             path = os.path.join(srcDir,file)
-            if os.path.isdir(path):
-                self.CollectCompilables(path,srcExts,includeDirs)
+            if isDir:
+                self.CollectCompilables(path,srcExts)
             elif GetExtension(file) in srcExts:
                 self.compileFiles.add(path)
-                self.FindFileDependencies(path,includeDirs)
     
     def CollectAllCompilables(self,mode,srcDirs,srcExts):
         self.compileFiles = set()
-        self.depdict = {}
-        self.invdict = {}
+        self.scannedDirs = set()
+        self.depdict = self.NewGraph(mode)
         self.rebuildList = []
         
-        includeDirs = self.GetPaths(mode,'includeDirs')
         for src in srcDirs:
-            self.CollectCompilables(src,srcExts,includeDirs)
+            self.CollectCompilables(src,srcExts)
         self.DebugPrint(f"Found {len(self.compileFiles)} source files.")
+
+    def GetScanJobs(self,mode):
+        if self.single:
+            return 1
+
+        jobs = GetModeVar(self.options,mode,'scanJobs')
+        if jobs<=0:
+            jobs = os.cpu_count() or 1
+        return jobs
+
+    def NewGraph(self,mode): # the interned graph takes far less memory on very large trees but is slower to build
+        return DepGraph() if GetModeVar(self.options,mode,'internGraph') else DictGraph()
+
+    def ScanAllDependencies(self,mode,useCache=True):
+        self.depdict = self.NewGraph(mode)
+        includeDirs = self.GetPaths(mode,'includeDirs')
+        self.OpenDepCache(mode,includeDirs)
+        if self.depCache and not useCache:
+            self.depCache.entries = {} # every file is read again, the results still refresh the cache
+
+        jobs = self.GetScanJobs(mode)
+        sources = sorted(self.compileFiles)
+        if jobs==1:
+            for src in sources:
+                if src not in self.depdict:
+                    self.FindFileDependencies(src,includeDirs)
+        else:
+            self.ParallelScan(mode,sources,includeDirs,jobs)
+        self.depdict.Compact()
         self.DebugPrint(f"Tracked {len(self.depdict)} total dependencies.")
+        resolver = GetIncludeResolver(includeDirs)
+        unresolved = sum(1 for path,dirs in resolver.resolved.values() if not path)
+        self.DebugPrint(f"Include resolver: {resolver.lookups} lookups, {resolver.hits} memoized, {unresolved} names not found in includeDirs")
+
+        if self.depCache:
+            self.DebugPrint(f"Dependency cache: {self.depCache.hits} hits, {self.depCache.misses} misses")
+            self.depCache.Save()
+
+    def ParallelScan(self,mode,sources,includeDirs,jobs): # every file is handed to a worker at most once
+        poolType = GetModeVar(self.options,mode,'scanPool')
+        if poolType=='process':
+            executor = concurrent.futures.ProcessPoolExecutor(jobs)
+        elif poolType=='thread':
+            executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        else:
+            self.InfoPrint(f"{ERROR()}Unknown scanPool '{poolType}', expected 'thread' or 'process'!")
+            ErrorExit()
+
+        seen = set()
+        pending = set()
+        stack = list(reversed(sources))
+        with executor:
+            while stack or pending:
+                while stack:
+                    path = stack.pop()
+                    if path in seen:
+                        continue
+                    seen.add(path)
+
+                    deps = None
+                    if self.depCache:
+                        stat = GetFileStat(path)
+                        if stat is None:
+                            continue
+                        deps = self.depCache.Lookup(path,stat)
+                    if deps is None:
+                        pending.add(executor.submit(ScanFile,self.depExtractFunc,path,includeDirs))
+                    else:
+                        self.depdict[path] = deps
+                        stack.extend(deps)
+
+                if not pending:
+                    break
+                done,pending = concurrent.futures.wait(pending,return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    path,stat,deps,probes = future.result()
+                    if stat is None:
+                        continue
+                    if self.depCache:
+                        self.depCache.Store(path,stat,deps,probes)
+                    self.depdict[path] = deps
+                    stack.extend(deps)
+
+    def OpenDepCache(self,mode,includeDirs,reuse=False): # reuse keeps the entries of the last scan of the same mode
+        key = [self.depExtractFunc.__name__,includeDirs]
+        path = self.GetStatePath(mode,'deps.json')
+        if reuse and self.depCache and self.depCache.path==path and self.depCache.key==key:
+            return
+        self.depCache = None
+        if not GetModeVar(self.options,mode,'depCache'):
+            return
+
+        self.depCache = DepCache(path,key)
+        self.depCache.Load()
 
     def GetRebuildSet(self,mode):
+        self.StartRebuildSet(mode)
+        self.FinishRebuildSet(mode)
+
+    def StartRebuildSet(self,mode): # find sources that are stale regardless of their headers
+        self.AssignTargets(mode)
+        self.linkInputs = None
         self.rebuildSet = set()
+        self.compileCommands = {}
+        self.commandHashes = CommandHashes(self.GetStatePath(mode,'commands.json'))
+        self.commandHashes.Load()
+        self.durations = CompileDurations(self.GetStatePath(mode,'durations.json'))
+        self.durations.Load()
+        self.estimates = {}
+        self.compileRate = None
+        self.contentHashes = None
+        self.signatures = {}
+        contentHash = GetModeVar(self.options,mode,'contentHash')
 
+        self.LoadUnity(mode)
+        unity = GetModeVar(self.options,mode,'unity')
+        for members in self.unityBatches.values():
+            if not unity or any(src not in self.compileFiles or self.IsUnityExcluded(mode,src) for src in members):
+                for src in members:
+                    if src in self.compileFiles and src not in self.rebuildSet:
+                        self.rebuildSet.add(src)
+                        self.DebugPrint(f"Adding source file {src}\nReason: its unity batch changed")
         for srcFile in self.compileFiles:
-            objFile = self.GetObjectFromSource(mode,srcFile)
-            if IsObjFileOutdated(srcFile,objFile):
+            cmd = self.GetCompileCommand(mode,srcFile)
+            self.compileCommands[srcFile] = cmd
+            if self.commandHashes.Changed(self.GetObjectFromSource(mode,srcFile),cmd):
+                self.rebuildSet.add(srcFile)
+                self.DebugPrint(f"Adding source file {srcFile}\nReason: compile command changed")
+                continue
+            objFile = self.GetBuiltObject(mode,srcFile)
+            if contentHash:
+                if GetFileStat(objFile) is None:
+                    self.rebuildSet.add(srcFile)
+                    self.DebugPrint(f"Adding source file {srcFile}\nReason: missing object")
+            elif IsObjFileOutdated(srcFile,objFile):
                 self.rebuildSet.add(srcFile)
                 self.DebugPrint(f"Adding source file {srcFile}\nReason: outdated object")
 
-        outputPath = self.GetOutputPath(mode)
-        outputAge = GetFileTime(outputPath)
-        self.DebugPrint(f'Output ({outputPath}) has age {outputAge}')
-        
-        includeDirs = self.GetPaths(mode,'includeDirs')
+    def FinishRebuildSet(self,mode): # add sources made stale by their headers, needs the dependency scan
+        if GetModeVar(self.options,mode,'contentHash') or self.objCache:
+            self.LoadContentSignatures(mode)
 
-        for headerFile in self.invdict:
-            headerAge = GetFileTime(headerFile)
-            for include in includeDirs:
-                if headerAge!=0:
-                    break
-                headerAge = GetFileTime(os.path.join(include,headerFile))
-            
-            if headerAge>=outputAge:
-                self.DebugPrint(f'Cascading {headerFile}...')
-                headerSet = self.HeaderFileCascade(mode,headerFile)
-                for srcFile in headerSet:
-                    objFile = self.GetObjectFromSource(mode,srcFile)
-                    if headerAge>=GetFileTime(objFile):
-                        if self.debug:
-                            if srcFile not in self.rebuildSet:
-                                self.DebugPrint(f"Adding source file {srcFile}\nReason: found in outdated header cascade")
-                        self.rebuildSet.add(srcFile)
+        if GetModeVar(self.options,mode,'contentHash'):
+            self.GetContentRebuildSet(mode)
+        else:
+            self.GetHeaderRebuildSet(mode)
 
         self.rebuildList = list(self.rebuildSet)
-        SortByFileTimesIP(self.rebuildList)
-        
+        self.SortByEstimate(mode,self.rebuildList)
+
+        if self.objCache:
+            self.cacheKeys = {src:self.GetCacheKey(mode,src) for src in self.rebuildList if src in self.signatures}
+
+    def OpenObjectCache(self,mode):
+        self.objCache = None
+        self.cacheKeys = {}
+        path = GetModeVar(self.options,mode,'objCache')
+        if not path:
+            return
+        if path is True:
+            path = GetDefaultCacheDir()
+        elif type(path) is list:
+            path = self.GetPath(mode,'objCache')
+        size = GetModeVar(self.options,mode,'objCacheSize')
+        self.objCache = ObjectCache(path,size*1024*1024)
+
+    def GetCompilerStamp(self,cmd): # a compiler upgrade must not restore objects built by the old one
+        compiler = cmd.split(' ',1)[0] if type(cmd) is str else cmd[0]
+        if compiler not in self.compilerStamps:
+            path = shutil.which(compiler)
+            stat = os.stat(path) if path else None
+            self.compilerStamps[compiler] = f'{path}:{stat.st_mtime_ns}:{stat.st_size}' if stat else compiler
+        return self.compilerStamps[compiler]
+
+    def GetCacheKey(self,mode,src): # the object path is left out so modes with the same flags share entries
+        cmd = self.GetCompiledMode(mode).GetCompileCommand(src,OUT_SLOT)
+        return HashString(f'{CommandString(cmd)}\n{self.GetCompilerStamp(cmd)}\n{self.signatures[src]}')
+
+    def GetCompileRate(self,mode): # seconds per source byte, measured from objects with a known duration
+        seconds,size = 0.0,0
+        for srcFile in self.compileFiles:
+            d = self.durations.Get(self.GetObjectFromSource(mode,srcFile))
+            stat = GetFileStat(srcFile)
+            if d is not None and stat and stat[1]>0:
+                seconds += d
+                size += stat[1]
+        if size==0:
+            return DEFAULT_COMPILE_RATE
+        return seconds/size
+
+    def GetCompileEstimate(self,mode,srcFile): # falls back to file size for files never compiled
+        if srcFile in self.estimates:
+            return self.estimates[srcFile]
+
+        d = self.durations.Get(self.GetObjectFromSource(mode,srcFile))
+        if d is None:
+            if self.compileRate is None:
+                self.compileRate = self.GetCompileRate(mode)
+            stat = GetFileStat(srcFile)
+            d = (stat[1] if stat else 0)*self.compileRate
+        self.estimates[srcFile] = d
+        return d
+
+    def SortByEstimate(self,mode,files): # longest compile first, newest first among equal estimates
+        SortByFileTimesIP(files)
+        files.sort(reverse=True,key=lambda f: self.GetCompileEstimate(mode,f))
+
+    def LoadContentSignatures(self,mode):
+        self.contentHashes = ContentHashes(self.GetStatePath(mode,'hashes.json'))
+        self.contentHashes.Load()
+
+        signatures = self.GetContentSignatures()
+        for srcFile in self.compileFiles:
+            if srcFile in signatures:
+                self.signatures[srcFile] = signatures[srcFile]
+
+        self.DebugPrint(f"Hashed {self.contentHashes.hashed} changed files.")
+        self.contentHashes.Save()
+
+    def GetContentRebuildSet(self,mode): # rebuild only sources whose bytes or included bytes changed
+        for srcFile,signature in self.signatures.items():
+            objFile = self.GetObjectFromSource(mode,srcFile)
+            if srcFile not in self.rebuildSet and self.contentHashes.Changed(objFile,signature):
+                self.rebuildSet.add(srcFile)
+                self.DebugPrint(f"Adding source file {srcFile}\nReason: contents changed")
+
+    def GetHeaderRebuildSet(self,mode):
+        newest = self.GetNewestDependencyTimes()
+        for srcFile in self.compileFiles:
+            if srcFile in self.rebuildSet or srcFile not in newest:
+                continue
+            age,header = newest[srcFile]
+            if age>=GetFileTime(self.GetBuiltObject(mode,srcFile)):
+                self.rebuildSet.add(srcFile)
+                self.DebugPrint(f"Adding source file {srcFile}\nReason: depends on outdated header {header}")
+
+    def GetNewestDependencyTimes(self): # newest (mtime,file) each file depends on, in one pass over the graph
+        graph = self.depdict
+        components,componentOf = graph.Condensed()
+        newest = {}
+        componentNewest = []
+        for c,members in enumerate(components):
+            best = (0,'')
+            for member in members:
+                path = graph.Path(member)
+                best = max(best,(GetFileTime(path),path))
+                for dep in graph.Deps(member):
+                    if componentOf[dep]!=c:
+                        best = max(best,componentNewest[componentOf[dep]])
+            componentNewest.append(best)
+            for member in members:
+                newest[graph.Path(member)] = best
+        return newest
+
+    def GetContentSignatures(self): # merkle hash over the condensed graph, changes with any included byte
+        graph = self.depdict
+        components,componentOf = graph.Condensed()
+        signatures = {}
+        componentSignatures = []
+        for c,members in enumerate(components):
+            paths = [graph.Path(member) for member in members]
+            parts = sorted(f'{path}:{self.contentHashes.GetHash(path)}' for path in paths)
+            deps = set()
+            for member in members:
+                for dep in graph.Deps(member):
+                    if componentOf[dep]!=c:
+                        deps.add(componentSignatures[componentOf[dep]])
+            parts.extend(sorted(deps))
+            signature = HashString(';'.join(parts))
+            componentSignatures.append(signature)
+            for path in paths:
+                signatures[path] = signature
+        return signatures
+
     def CollectObjectsSub(self,path,l,objExt):
-        for entry in os.listdir(path):
+        for entry,isDir,isFile in statCache.ListDir(path):
             real = os.path.join(path,entry)
-            if os.path.isdir(real):
+            if isDir:
                 self.CollectObjectsSub(real,l,objExt)
-            elif os.path.isfile(real):
+            elif isFile:
                 if GetExtension(real)==objExt:
                     l.append(real)
 
     def GetObjectPaths(self,mode):
-        d = self.GetPath(mode,'objDir')
-        ext = GetModeVar(self.options,mode,'objExt')
+        compiled = self.GetCompiledMode(mode)
+        d = compiled.objDir
+        ext = compiled.objExt
         objs = []
         self.CollectObjectsSub(d,objs,ext)
+        return objs
         
-        s = ''
-        for file in objs:
-            s += file+' '
-            
-        return s[:-1]
-        
-    def GetObjectFromSource(self,mode,src):
-        d = self.GetPath(mode,'objDir')
-        return os.path.join(d,AddExtension(src,GetModeVar(self.options,mode,'objExt')))
+    def GetObjectFromSource(self,mode,src): # also the key of the source's state when it is built in a unity batch
+        return self.GetCompiledMode(mode).GetObject(src)
+
+    def GetBuiltObject(self,mode,src): # the object that holds the code of src
+        return self.batchOf.get(src) or self.GetObjectFromSource(mode,src)
+
+    def GetStatePath(self,mode,name): # files builder keeps between runs live in objDir/.builder
+        return os.path.join(self.GetPath(mode,'objDir'),'.builder',name)
 
     def GetOutputPath(self,mode):
-        d = self.GetPath(mode,'outputDir')
-        return os.path.join(d,GetModeVar(self.options,mode,'outputName'))
+        return self.GetCompiledMode(mode).outputPath
 
     def GetBuilderPath(self):
         return os.path.abspath(__file__)
@@ -340,19 +2048,19 @@ class Builder:
                 self.TestDirs(real,submode['modes'])
                 continue
                 
-            if GetModeVar(self.options,real,'linkCmd'):
+            if GetModeVar(self.options,real,'linkCmd') or GetModeVar(self.options,real,'targets'):
                 test = self.GetPath(real,'outputDir')
-                if not os.path.exists(test):
+                if not statCache.Exists(test):
                     MakePath(test)
             
             if GetModeVar(self.options,real,'compileCmd'):
                 test = self.GetPath(real,'objDir')
-                if not os.path.exists(test):
+                if not statCache.Exists(test):
                     MakePath(test)
             
             test = self.GetPaths(real,'srcDirs')
             for path in test:
-                if not os.path.exists(path):
+                if not statCache.Exists(path):
                     MakePath(path)
                 
     def GetPath(self,mode,name):
@@ -383,6 +2091,14 @@ class Builder:
             var = self.FlagListPreprocess(properMode,name,var)
         
         return self.GetCommandFlags(mode,var,infile,outfile)
+
+    def GetCommandArgs(self,mode,name,infile='%in',outfile='%out'): # like GetCommand, as an argv list
+        var = GetModeVar(self.options,mode,name)
+        properMode = GetModeMode(self.options,mode,name)
+        if type(var) is list:
+            var = self.FlagListPreprocess(properMode,name,var)
+
+        return self.GetCommandFlagArgs(mode,var,infile,outfile)
         
     def FlagListPreprocess(self,mode,name,flagList):
         newList = []
@@ -401,7 +2117,15 @@ class Builder:
         
         return newList
 
-    def ResolveFlag(self,mode,flag,inFlag='%in',outFlag='%out'):
+    def ResolveFlagArgs(self,mode,flag,inFlag='%in',outFlag='%out'): # list variables stay separate arguments
+        value = self.ResolveFlag(mode,flag,inFlag,outFlag,True)
+        if type(value) is list:
+            return value
+        if 'Dir' in flag or flag=='%modePath': # paths may contain spaces
+            return [value]
+        return SplitFlag(value)
+
+    def ResolveFlag(self,mode,flag,inFlag='%in',outFlag='%out',asArgs=False):
         if flag[:2]=='\\%': return flag[1:] # escaped flag name
         if flag=='%mode':
             return ModeStr(mode)
@@ -412,7 +2136,7 @@ class Builder:
         if flag=='%modeFirst':
             return mode[0]
         if flag=='%self':
-            return 'python '+self.GetBuilderPath()
+            return JoinArgs(['python',self.GetBuilderPath()])
         if flag=='%utime':
             return str(int(time.time()))
         if flag=='%platform':
@@ -425,6 +2149,8 @@ class Builder:
                 nv = self.FlagListPreprocess(proper,flag[1:],var)
                 if 'Dir' in flag:
                     return self.ResolvePath(mode,nv)
+                if asArgs:
+                    return self.GetCommandFlagArgs(mode,nv,inFlag,outFlag)
                 return self.GetCommandFlags(mode,nv,inFlag,outFlag)
                 
             return str(var)
@@ -497,101 +2223,356 @@ class Builder:
             
         return cmd.lstrip()
 
-    def GetCompileCommand(self,mode,file):
-        objVersion = self.GetObjectFromSource(mode,file)
-        command = self.GetCommand(mode,'compileCmd',file,objVersion)
+    def GetCommandFlagArgs(self,mode,flags,infile,outfile): # like GetCommandFlags, but %in and %out are never split
+        if type(flags) is str:
+            return SplitFlag(flags)
+
+        args = []
+        for flag in flags:
+            concat = False
+            if flag == '':
+                continue
+
+            if flag[0] == '#' or flag[:2] == '\\#':
+                concat = flag[0]=='#'
+                flag = flag[1:]
+
+            if flag[0] == '%' or flag[:2] == '\\%':
+                if flag[1:] == 'out':
+                    parts = [outfile]
+                elif flag[1:] == 'in':
+                    parts = [infile]
+                else:
+                    parts = self.ResolveFlagArgs(mode,flag,infile,outfile)
+            else:
+                parts = SplitFlag(flag)
+
+            if not parts or parts==['']:
+                continue
+
+            if concat and args:
+                args[-1] += parts[0]
+                parts = parts[1:]
+            args.extend(parts)
+
+        return args
+
+    def ResolveCompileArgs(self,mode,infile,outfile): # argv version of ResolveCompileCommand
+        args = self.GetCommandArgs(mode,'compileCmd',infile,outfile)
+        flag = GetModeVar(self.options,mode,'includeFlag')
+        for include in self.GetPaths(mode,'includeDirs'):
+            args += [flag,include]
+        return args
+
+    def ResolveCompileCommand(self,mode,infile,outfile): # resolves every variable, use GetCompileCommand per file
+        command = self.GetCommand(mode,'compileCmd',infile,outfile)
         includes = self.GetPaths(mode,'includeDirs')
         flag = GetModeVar(self.options,mode,'includeFlag')
         for include in includes:
             command += ' '+flag+' '+include
         return command
 
+    def GetCompileCommand(self,mode,file):
+        compiled = self.GetCompiledMode(mode)
+        return compiled.GetCompileCommand(file,compiled.GetObject(file))
+
     def GetLinkCommand(self,mode):
         inputFiles = self.GetObjectPaths(mode)
         outputFile = self.GetOutputPath(mode)
-        return self.GetCommand(mode,'linkCmd',inputFiles,outputFile)
+        return self.GetCompiledMode(mode).GetLinkCommand(inputFiles,outputFile)
     
-    def RunCommand(self,cmd):
-        p = subprocess.Popen(cmd,stdout=sys.stdout,stderr=sys.stderr,shell=True)
-        return p.wait()
+    def RunCommand(self,cmd,name='command'):
+        with self.Trace(name,'process',cmd=CommandString(cmd)) as span:
+            span.args['exit'] = StartProcess(cmd).wait()
+        return span.args['exit']
+
+    def HasBuildSteps(self,mode):
+        return bool(GetModeVar(self.options,mode,'compileCmd') or GetModeVar(self.options,mode,'linkCmd'))
 
     def Scan(self,mode):
-        if GetModeVar(self.options,mode,'compileCmd') or GetModeVar(self.options,mode,'linkCmd'):
+        if self.HasBuildSteps(mode):
             self.GetDepExtractFunc(mode)
             srcDirs = self.GetPaths(mode,'srcDirs')
             self.CollectAllCompilables(mode,srcDirs,self.GetSourceExts(mode))
-            self.InvertDependencies()
+            self.ScanAllDependencies(mode)
             self.GetRebuildSet(mode)
             
-    def RequestCommand(self):
-        with self.dispatchLock:
-            if self.dispatchedCommands:
-                return True,self.dispatchedCommands.pop(0)
-        
-        return False,None
-	
-    def BuildObjectsFromList(self,totalCount):
-        code = 0
+    def GetJobCount(self):
+        if self.single:
+            return 1
+        if self.jobs>0:
+            return self.jobs
+        return os.cpu_count() or 1
+
+    def GetWorkerCount(self): # local jobs, plus a thread for every remote compile slot
+        remote = self.OpenRemote()
+        return self.GetJobCount()+(remote.slots if remote else 0)
+
+    def OpenRemote(self):
+        if self.remote is None and self.workerAddresses and not self.single:
+            self.remote = RemoteWorkers(self.workerAddresses,self.GetJobCount())
+        return self.remote
+
+    def IsRemoteJob(self,src,obj,cmd): # workers only get files below the project directory
+        if type(cmd) is not list or self.scanning or src not in self.depdict: # a half scanned graph misses headers
+            return False
+        for path in self.GetTransitiveDeps(src)|{obj}:
+            # generated files under .builder refer to the project by absolute paths
+            if not IsProjectPath(path) or '.builder' in os.path.normpath(path).split(os.path.sep):
+                return False
+        return True
+
+    def RunCompile(self,src,obj,cmd): # compile on a free remote slot when possible, locally otherwise
+        remote = self.remote
+        if remote is None:
+            return self.scheduler.RunProcess(cmd)
+
+        if self.IsRemoteJob(src,obj,cmd):
+            address = remote.Acquire()
+            if address:
+                try:
+                    ok = self.CompileRemote(address,src,obj,cmd)
+                finally:
+                    remote.Release(address)
+                if ok:
+                    return 0
+        with remote.local:
+            return self.scheduler.RunProcess(cmd)
+
+    def CompileRemote(self,address,src,obj,cmd): # return True if the worker built obj
+        name = f'{address[0]}:{address[1]}'
+        try:
+            files = sorted(os.path.normpath(path) for path in self.GetTransitiveDeps(src))
+            blobs = []
+            for path in files:
+                with open(path,'rb') as f:
+                    blobs.append(f.read())
+        except OSError:
+            return False
+
+        request = {'version':REMOTE_VERSION,'op':'compile','token':GetWorkerToken(),'cmd':cmd,'obj':os.path.normpath(obj),
+            'files':[[path,len(blob)] for path,blob in zip(files,blobs)]}
+        try:
+            with self.Trace('remote compile','process',src=src,worker=name):
+                with socket.create_connection(address,REMOTE_CONNECT_TIMEOUT) as sock:
+                    sock.settimeout(REMOTE_COMPILE_TIMEOUT)
+                    SendMessage(sock,request,blobs)
+                    with sock.makefile('rb') as f:
+                        reply = ReadMessage(f)
+                        data = ReadBlob(f,reply['size'])
+                        code = reply['exit']
+        except (OSError,ValueError,KeyError,TypeError,ConnectionError) as e:
+            self.ThreadedPrint(f"{TextColor(YELLOW)}Worker {name} failed ({e}), compiling locally from now on.{RESET()}")
+            self.remote.Drop(address)
+            return False
+
+        if code!=0: # also a toolchain the worker does not have, the local compiler gives the real errors
+            self.DebugPrint(f"{src} did not compile on {name}, compiling it locally.")
+            return False
+        if reply.get('output'):
+            self.ThreadedPrint(reply['output'],end='')
+        tmp = f'{obj}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp,'wb') as f:
+            f.write(data)
+        os.replace(tmp,obj)
+        self.DebugPrint(f"Compiled {src} on {name}")
+        return True
+
+    def CompileObject(self,src,obj,cmd,index):
         threadName = threading.current_thread().name
-        while True:
-            status,req = self.RequestCommand()
-            if not status:
-                break
-            if self.HasCommandFailed():
-                quit()
-                
-            src,obj,cmd,index = req[0],req[1],req[2],req[3]
-            objDir = os.path.dirname(obj)
-            with self.pathLock:
-                if not os.path.exists(objDir):
-                    MakePathSub(objDir)
-                    self.DebugPrint(f"{TextColor(MAGENTA)}Created build path {objDir}{RESET()}")
-                
-            if self.debug:
-                self.ThreadedPrint(f"{TextColor(BLUE)}{cmd}{RESET()}")
-            else:
-                self.ThreadedPrint(f'{TextColor(WHITE,1)}[{MODE()}{threadName}{TextColor(WHITE,1)}] {TextColor(GREEN)}Building ({index+1}/{totalCount}): {TextColor(YELLOW)}{src} {TextColor(WHITE,1)}-> {TextColor(BLUE)}{obj}{RESET()}')
+        objDir = os.path.dirname(obj)
+        with self.pathLock:
+            if not statCache.Exists(objDir):
+                MakePathSub(objDir)
+                self.DebugPrint(f"{TextColor(MAGENTA)}Created build path {objDir}{RESET()}")
+            
+        queueWait = round(self.scheduler.GetQueueWait()*1000,3)
+        key = self.cacheKeys.get(src)
+        restored = False
+        if key:
+            with self.Trace('restore',src=src,obj=obj,queueWaitMs=queueWait) as span:
+                restored = self.objCache.Restore(key,obj)
+                span.args['hit'] = restored
+        if restored:
+            self.ThreadedPrint(f'{TextColor(WHITE,1)}[{MODE()}{threadName}{TextColor(WHITE,1)}] {TextColor(GREEN)}Cached ({index+1}/{self.dispatchTotal}): {TextColor(YELLOW)}{src} {TextColor(WHITE,1)}-> {TextColor(BLUE)}{obj}{RESET()}')
+            statCache.Invalidate(obj)
+            with self.dispatchLock:
+                self.builtObjects.append((src,obj,cmd,None))
+            return True
 
-            code = self.RunCommand(cmd)
-            if code!=0:
-                self.SetCommandFailed()
-                break
-                
-        return code
+        if self.debug:
+            self.ThreadedPrint(f"{TextColor(BLUE)}{CommandString(cmd)}{RESET()}")
+        else:
+            self.ThreadedPrint(f'{TextColor(WHITE,1)}[{MODE()}{threadName}{TextColor(WHITE,1)}] {TextColor(GREEN)}Building ({index+1}/{self.dispatchTotal}): {TextColor(YELLOW)}{src} {TextColor(WHITE,1)}-> {TextColor(BLUE)}{obj}{RESET()}')
 
-    def HasCommandFailed(self):
-        with self.failLock:
-            return self.commandFailed
+        start = time.perf_counter()
+        with self.Trace('compile','process',src=src,obj=obj,queueWaitMs=queueWait) as span:
+            code = self.RunCompile(src,obj,cmd)
+            span.args['exit'] = code
+        duration = time.perf_counter()-start
+        if code!=0:
+            # a failed or killed compiler may leave a partial object that looks up to date
+            if os.path.exists(obj):
+                os.remove(obj)
+            statCache.Invalidate(obj)
+            if not self.scheduler.IsCancelled():
+                self.ThreadedPrint(f"{ERROR()}Failed to build {src}{RESET()}")
+            return False
+
+        statCache.Invalidate(obj)
+        if key:
+            self.objCache.Insert(key,obj)
+        with self.dispatchLock:
+            self.builtObjects.append((src,obj,cmd,duration))
+        return True
+
+    def StartDispatch(self,scheduler=None): # start the compile scheduler, commands can be added until FinishDispatch
+        self.dispatchTotal = 0
+        self.dispatchDone = 0
+        self.dispatchFailed = False
+        self.dispatchClosed = False
+        self.onCompilesDone = None
+        self.dispatchEstimates = []
+        self.dispatchStart = time.perf_counter()
+        self.builtObjects = []
+        self.scheduler = scheduler or JobScheduler(self.GetWorkerCount(),self.keepGoing)
+
+    def AddCommands(self,cmdList,estimates=None): # jobs with the highest estimate run first
+        with self.dispatchLock:
+            start = self.dispatchTotal
+            self.dispatchTotal += len(cmdList)
+            for src,obj,cmd in cmdList:
+                if src in self.targetOf:
+                    self.targetOf[src].pending += 1
+        for i,(src,obj,cmd) in enumerate(cmdList):
+            estimate = estimates[i] if estimates else 0
+            self.dispatchEstimates.append((estimate,src))
+            self.scheduler.Submit(self.CompileJob,(src,obj,cmd,start+i),estimate)
+
+    def CompileJob(self,src,obj,cmd,index): # counts finished jobs, so a mode knows when its own objects are done
+        ok = False
+        try:
+            ok = self.CompileObject(src,obj,cmd,index)
+        finally:
+            with self.dispatchLock:
+                self.dispatchDone += 1
+                if not ok:
+                    self.dispatchFailed = True
+            self.CheckCompilesDone()
+            if src in self.targetOf:
+                self.FinishTargetInput(self.targetOf[src],ok)
+        return ok
 
-    def SetCommandFailed(self):
-        with self.failLock:
-            self.commandFailed = True
+    def CloseDispatch(self,onCompilesDone): # no more commands will be added, call onCompilesDone once all have finished
+        with self.dispatchLock:
+            self.dispatchClosed = True
+            self.onCompilesDone = onCompilesDone
+        self.CheckCompilesDone()
+        for target in self.targets:
+            self.CheckTargetReady(target)
+
+    def FinishTargetInput(self,target,ok): # one object or link input of target is done
+        with self.dispatchLock:
+            target.pending -= 1
+            if not ok:
+                target.failed = True
+        self.CheckTargetReady(target)
+
+    def CheckTargetReady(self,target):
+        with self.dispatchLock:
+            ready = self.dispatchClosed and target.pending==0 and not target.queued
+            if ready:
+                target.queued = True
+        if not ready:
+            return
+        if target.failed:
+            self.DebugPrint(f"Skipping target {target.name}, one of its inputs failed.")
+            self.FinishTarget(target,False)
+        else:
+            self.scheduler.Submit(self.TargetJob,(target,),LINK_PRIORITY)
 
-    def CommandFailedQuit(self):
-        if self.HasCommandFailed():
-            self.ThreadedPrint(f"{ERROR()}Not all files were successfully compiled!")
+    def TargetJob(self,target):
+        ok = self.Link(self.targetMode,target)
+        self.FinishTarget(target,ok)
+        return ok
+
+    def FinishTarget(self,target,ok):
+        target.built = ok
+        for dependent in target.dependents:
+            self.FinishTargetInput(dependent,ok)
+
+    def TargetsBuilt(self):
+        return all(target.built for target in self.targets)
+
+    def CheckCompilesDone(self):
+        with self.dispatchLock:
+            callback = None
+            if self.dispatchClosed and self.onCompilesDone and self.dispatchDone==self.dispatchTotal:
+                callback,self.onCompilesDone = self.onCompilesDone,None
+        if callback:
+            callback()
+
+    def FinishDispatch(self):
+        try:
+            with self.Trace('wait for compiles'):
+                ok = self.scheduler.Wait()
+        finally:
+            with self.Trace('record built objects'):
+                self.RecordBuiltObjects()
+        self.PrintCriticalPath(time.perf_counter()-self.dispatchStart)
+
+        if not ok:
+            if self.dispatchFailed: # otherwise a target's link failed, which was already reported
+                if self.keepGoing:
+                    self.InfoPrint(f"{ERROR()}{self.scheduler.failures} of {self.dispatchTotal} jobs failed!")
+                self.InfoPrint(f"{ERROR()}Not all files were successfully compiled!")
             ErrorExit()
-            quit()
 
-    def DispatchCommands(self,cmdList,totalCount):
-        cores = os.cpu_count()
-        if self.single:
-            cores = 1
-        self.dispatchedCommands = cmdList
+    def DispatchCommands(self,cmdList):
+        self.StartDispatch()
+        self.AddCommands(cmdList)
+        self.FinishDispatch()
 
-        for i in range(cores):
-            thread = threading.Thread(target=self.BuildObjectsFromList,args=(totalCount,),name=str(i+1))
-            thread.start()
-            if self.single:
-                thread.join()
-        
-        while threading.active_count()!=1:
-            if self.HasCommandFailed():
-                quit()
-            time.sleep(0.25)
+    def RecordBuiltObjects(self): # signatures are only known once scanning is done
+        with self.dispatchLock:
+            built = list(self.builtObjects)
 
-        if self.HasCommandFailed():
-            self.CommandFailedQuit()
+        for src,obj,cmd,duration in built:
+            self.commandHashes.Update(obj,cmd)
+            if self.durations and duration is not None:
+                self.durations.Update(obj,duration)
+            if self.contentHashes and src in self.signatures:
+                self.contentHashes.Update(obj,self.signatures[src])
+            for member,key in self.unityMembers.get(src,()): # a batch is up to date for each of its sources
+                self.commandHashes.Update(key,self.compileCommands[member])
+                if self.contentHashes and member in self.signatures:
+                    self.contentHashes.Update(key,self.signatures[member])
+
+        self.commandHashes.Save()
+        if self.durations:
+            self.durations.Save()
+        if self.contentHashes:
+            self.contentHashes.Save()
+        if self.linkInputs:
+            self.linkInputs.Save()
+
+        if self.objCache:
+            removed = self.objCache.Evict()
+            self.objCache.SaveStats()
+            self.DebugPrint(f"Object cache: {self.objCache.hits} hits, {self.objCache.misses} misses, {removed} entries evicted")
+
+    def PrintCriticalPath(self,elapsed):
+        if not self.debug or not self.dispatchEstimates:
+            return
+
+        jobs = self.GetJobCount()
+        predicted = PredictMakespan([e for e,src in self.dispatchEstimates],jobs)
+        longestEstimate,longestSrc = max(self.dispatchEstimates)
+        self.DebugPrint(f"Predicted compile time: {predicted:.2f}s on {jobs} jobs, longest job {longestSrc} ({longestEstimate:.2f}s)")
+        compiled = [b for b in self.builtObjects if b[3] is not None]
+        if compiled:
+            src,obj,cmd,duration = max(compiled,key=lambda b: b[3])
+            self.DebugPrint(f"Actual compile time:    {elapsed:.2f}s on {jobs} jobs, longest job {src} ({duration:.2f}s)")
 
     def GetDefaultMode(self,op):
         m = op['defaultMode']
@@ -619,18 +2600,35 @@ class Builder:
         self.InfoPrint(f"{ERROR()}Mode {MODE()}{ModeStr(mode)}{ERROR()} not found!")
         ErrorExit()
 
-    def GetCommands(self,mode,cmdList):
+    def GetCommands(self,mode,cmdList): # argv lists, or strings for commands that need the shell
         properCmds = []
         for cmd in cmdList:
+            shell = type(cmd) is dict # {"shell": command} always runs through the shell
+            if shell:
+                cmd = cmd.get('shell','')
+
+            args = None
             if type(cmd) is list:
                 builtCmd = self.GetCommandFlags(mode,cmd,'%in','%out')
-                properCmds.append(builtCmd)
+                if not shell:
+                    try:
+                        args = self.GetCommandFlagArgs(mode,cmd,'%in','%out')
+                    except ValueError: # unbalanced quotes are left for the shell to report
+                        pass
             elif type(cmd) is str:
-                if cmd[0]=='%':
-                    cmd = self.ResolveFlag(mode,cmd)
-                    properCmds.append(cmd)
-                else:
-                    properCmds.append(cmd)
+                builtCmd = self.ResolveFlag(mode,cmd) if cmd[:1]=='%' else cmd
+                if not shell:
+                    try:
+                        args = self.ResolveFlagArgs(mode,cmd) if cmd[:1]=='%' else SplitFlag(cmd)
+                    except ValueError:
+                        pass
+            else:
+                continue
+
+            if args is None or NeedsShell(args):
+                properCmds.append(builtCmd)
+            elif args:
+                properCmds.append(args)
                 
         return properCmds
 
@@ -646,18 +2644,23 @@ class Builder:
         self.InfoPrint(f'{TextColor(WHITE,1)}Done!{RESET()}')
 
     def GetDepExtractFunc(self,mode):
-        self.depExtractFunc = CPPDeps
+        scanner = GetModeVar(self.options,mode,'depScanner')
+        if scanner not in DEP_SCANNERS:
+            self.InfoPrint(f"{ERROR()}Unknown depScanner '{scanner}', expected {' or '.join(repr(name) for name in DEP_SCANNERS)}!")
+            ErrorExit()
+        self.depExtractFunc = DEP_SCANNERS[scanner]
         
     def PruneObjectsSub(self,path,ext,srcExts):
-        files = os.listdir(path)
-        for file in files:
+        for file,isDir,isFile in statCache.ListDir(path):
             p = os.path.join(path,file)
-            if os.path.isdir(p):
+            if isDir:
                 self.PruneObjectsSub(p,ext,srcExts)
-            elif os.path.isfile(p):
+            elif isFile:
                 if GetExtension(file)==ext:
                     prune = False
-                    if os.path.getsize(p)==0:
+                    if p in self.unityBatches:
+                        continue
+                    if GetFileStat(p)[1]==0:
                         prune = True
                         self.DebugPrint(f"Pruned zero-size object: {p}")
                     else:
@@ -677,18 +2680,109 @@ class Builder:
                     if prune:
                         self.DebugPrint(f"Removing {p}")
                         os.remove(p)
+                        statCache.Invalidate(p)
                         self.pruned = True
         
     def PruneObjects(self,mode):
         self.pruned = False
+        self.LoadUnity(mode)
         objDir = self.GetPath(mode,'objDir')
         objExt = GetModeVar(self.options,mode,'objExt')
         srcExts = GetModeVar(self.options,mode,'srcExts')
         
         self.PruneObjectsSub(objDir,objExt,srcExts)
-        
-        if self.pruned:
-            self.Scan(mode)
+
+    def GetManifestStamps(self,paths):
+        stamps = {}
+        for path in paths:
+            stat = GetFileStat(path)
+            stamps[path] = stat[0] if stat else None
+        return stamps
+
+    def WriteManifest(self,mode):
+        compiling = GetModeVar(self.options,mode,'compileCmd')!=''
+        linking = GetModeVar(self.options,mode,'linkCmd')!=''
+
+        inputs = list(self.depdict.keys())
+        if self.builderFile:
+            inputs.append(self.builderFile)
+        dirs = set(self.scannedDirs)
+        dirs.update(self.GetPaths(mode,'includeDirs'))
+        dirs.update(os.path.dirname(path) or '.' for path in self.depdict)
+        # builder's own state, like the PCH header, changes whenever state files such as this manifest are written
+        stateDir = os.path.normpath(os.path.dirname(self.GetStatePath(mode,'manifest.json')))
+        dirs = {d for d in dirs if not IsInDirs(d,[stateDir])}
+
+        commands = {}
+        outputs = []
+        if compiling:
+            for file in self.compileFiles:
+                obj = self.GetObjectFromSource(mode,file)
+                commands[obj] = self.GetCompileCommand(mode,file)
+                outputs.append(self.GetBuiltObject(mode,file))
+            if self.UsesPCH(mode):
+                compiled = self.GetCompiledMode(mode)
+                commands[compiled.pchOutput] = compiled.GetPchCommand()
+                outputs.append(compiled.pchOutput)
+        if self.targets:
+            for target in self.targets:
+                cmd,output,_ = self.GetLinkStep(mode,target)
+                commands[output] = cmd
+                outputs.append(output)
+        elif linking:
+            output = self.GetOutputPath(mode)
+            commands[output] = self.GetLinkCommand(mode)
+            outputs.append(output)
+        # a lost command hash file rebuilds every object, so it must not be skipped past
+        commandHashes = self.GetStatePath(mode,'commands.json')
+        if GetFileStat(commandHashes):
+            outputs.append(commandHashes)
+
+        manifest = {
+            'version':MANIFEST_VERSION,
+            'mode':mode,
+            'inputs':self.GetManifestStamps(inputs),
+            'outputs':self.GetManifestStamps(outputs),
+            'dirs':self.GetManifestStamps(dirs),
+            'commands':commands,
+            'commandsHash':self.GetCompiledMode(mode).GetCommandsHash()
+        }
+        WriteJSONFile(self.GetStatePath(mode,'manifest.json'),manifest)
+
+    def IsUpToDate(self,mode): # compare the last successful build's manifest against the filesystem
+        if not self.HasBuildSteps(mode):
+            return True
+
+        manifest = ReadJSONFile(self.GetStatePath(mode,'manifest.json'))
+        if type(manifest) is not dict or manifest.get('version')!=MANIFEST_VERSION:
+            return False
+        if manifest.get('mode')!=mode:
+            return False
+
+        try:
+            for section in ('inputs','outputs','dirs'):
+                for path,stamp in manifest[section].items():
+                    stat = GetFileStat(path)
+                    if stat is None or stat[0]!=stamp:
+                        self.DebugPrint(f"Manifest out of date: {path}")
+                        return False
+        except (KeyError,AttributeError,TypeError):
+            return False
+
+        if manifest.get('commandsHash')!=self.GetCompiledMode(mode).GetCommandsHash():
+            self.DebugPrint("Manifest out of date: commands changed")
+            return False
+
+        return True
+
+    def Check(self,mode):
+        mode = self.FixMode(mode)
+        if self.IsUpToDate(mode):
+            self.InfoPrint(f"{MODE()}{ModeStr(mode)}{TextColor(WHITE,1)} is up to date.{RESET()}")
+            return True
+
+        self.InfoPrint(f"{MODE()}{ModeStr(mode)}{TextColor(YELLOW,1)} is out of date.{RESET()}")
+        return False
 
     def IsBlankMode(self,mode):
         cc = GetModeVar(self.options,mode,'compileCmd')
@@ -709,7 +2803,33 @@ class Builder:
 
         return True
 
-    def Build(self,mode):
+    def Build(self,mode,incremental=False): # incremental builds reuse the graph kept by Watch
+        with self.Trace(f"build {ModeStr(mode) or 'default'}"):
+            self.BuildSub(mode,incremental)
+
+    def BuildSub(self,mode,incremental):
+        mode,postCmds = self.StartBuild(mode)
+
+        with self.Trace('up to date check'):
+            upToDate = self.HasBuildSteps(mode) and self.IsUpToDate(mode)
+        if upToDate:
+            self.InfoPrint(f'{TextColor(WHITE,1)}Up to date.{RESET()}')
+            self.RunPostCommands(postCmds)
+            self.Done()
+            return
+
+        if self.HasBuildSteps(mode):
+            self.CompileObjects(mode,incremental)
+
+        if self.targets:
+            if not self.TargetsBuilt():
+                ErrorExit()
+        elif self.IsLinking(mode) and not self.Link(mode):
+            ErrorExit()
+
+        self.FinishBuild(mode,postCmds)
+
+    def StartBuild(self,mode): # apply the mode's settings and run its preCmds, return the full mode and its postCmds
         if mode==[]:
             mode = self.FixMode(mode)
             self.InfoPrint(f"{TextColor(WHITE,1)}Using default mode {MODE()}{ModeStr(mode)}{RESET()}")
@@ -720,7 +2840,6 @@ class Builder:
 
         preCmds = self.GetPreCommands(mode)
         postCmds = self.GetPostCommands(mode)
-        code = 0
         
         settings = GetModeVar(self.options,mode,'set')
         if settings:
@@ -728,58 +2847,788 @@ class Builder:
                 if key[0]=='%' or key[:2]=='\\%':
                     key = self.ResolveFlag(mode,key)
                 self.options[key] = value
+            self.compiledModes = {}
 
         for command in preCmds:
-            self.DebugPrint(f"{TextColor(MAGENTA)}{command}{RESET()}")
-            code = self.RunCommand(command)
+            self.DebugPrint(f"{TextColor(MAGENTA)}{CommandString(command)}{RESET()}")
+            code = self.RunCommand(command,'preCmd')
             if code!=0:
                 ErrorExit()
 
-        self.Scan(mode)
+        # preCmds may generate files, so metadata is only cached from here on
+        ResetStatCache()
+        return mode,postCmds
 
-        errored = False
-        cmd = ''
-        
-        if self.DirContainsObjects(mode):
-            self.PruneObjects(mode)
-            
-        compileCount = len(self.rebuildList)
-        # compilation
-        if compileCount!=0 and GetModeVar(self.options,mode,'compileCmd')!='':
-            self.InfoPrint(f'{TextColor(WHITE,1)}Building {MODE()}{compileCount}{TextColor(WHITE,1)} files...')
-            
-            cmdList = [(file,self.GetObjectFromSource(mode,file),self.GetCompileCommand(mode,file),i) for i,file in enumerate(self.rebuildList)]
-            
-            self.DispatchCommands(cmdList,compileCount)
-            if errored:
-                self.InfoPrint(f"{ERROR()}Not all files were successfully compiled!")
-                ErrorExit()
-                
-        # linking
-        if GetModeVar(self.options,mode,'linkCmd')!='':
-            self.InfoPrint(f'{TextColor(WHITE,1)}Linking executable...{RESET()}')
+    def IsLinking(self,mode):
+        return GetModeVar(self.options,mode,'linkCmd')!=''
 
-            cmd = self.GetLinkCommand(mode)
-            if self.debug:
-                self.InfoPrint(f'{TextColor(BLUE)}{cmd}{RESET()}')
-            else:
-                src = os.path.normpath(self.GetPath(mode,'objDir'))
-                dest = self.GetOutputPath(mode)
-                self.InfoPrint(f'{TextColor(GREEN)}Linking: {TextColor(BLUE)}{src} {TextColor(WHITE,1)}-> {TextColor(GREEN,1)}{dest}{RESET()}')
-            code = self.RunCommand(cmd)
+    def NeedsLink(self,mode,cmd,output,objs,linkInputs):
+        if self.commandHashes.Changed(output,cmd):
+            self.DebugPrint(f"Link command changed for {output}")
+            return True
+        outStat = GetFileStat(output)
+        if outStat is None:
+            return True
 
-            if code!=0:
-                self.InfoPrint(f"{ERROR()}Linker error!")
+        for obj in objs:
+            stat = GetFileStat(obj)
+            if stat is None:
+                return True
+            if stat[0]<=outStat[0]:
+                continue
+            if linkInputs and linkInputs.Unchanged(output,obj,stat):
+                self.DebugPrint(f"Restat: {obj} is unchanged")
+                continue
+            self.DebugPrint(f"Newer than {output}: {obj}")
+            return True
+        return False
+
+    def GetLinkStep(self,mode,target=None): # command, output and inputs of the mode's link or of a target
+        if target is None:
+            return self.GetLinkCommand(mode),self.GetOutputPath(mode),self.GetObjectPaths(mode)
+        compiled = self.GetCompiledMode(mode)
+        inputs = list(dict.fromkeys(self.GetBuiltObject(mode,src) for src in target.sources))
+        inputs += [dep.output for dep in target.linkDeps]
+        return compiled.GetTargetCommand(target,inputs),target.output,inputs
+
+    def OpenLinkInputs(self,mode): # shared by every link of the build, they may run at the same time
+        if not GetModeVar(self.options,mode,'restat'):
+            return None
+        with self.dispatchLock:
+            if self.linkInputs is None:
+                self.linkInputs = LinkInputs(self.GetStatePath(mode,'links.json'))
+                self.linkInputs.Load()
+            return self.linkInputs
+
+    def Link(self,mode,target=None): # return False if the linker failed, also runs on compile workers
+        cmd,output,objs = self.GetLinkStep(mode,target)
+        linkInputs = self.OpenLinkInputs(mode)
+
+        with self.Trace('link check',output=output):
+            needed = self.NeedsLink(mode,cmd,output,objs,linkInputs)
+        if not needed:
+            self.ThreadedPrint(f'{TextColor(WHITE,1)}Skipping link, {TextColor(GREEN,1)}{output}{TextColor(WHITE,1)} is up to date.{RESET()}')
+            if linkInputs and not target:
+                linkInputs.Save()
+            return True
+
+        if target:
+            self.ThreadedPrint(f'{TextColor(WHITE,1)}{TARGET_ACTIONS[target.kind]} {MODE()}{target.name}{TextColor(WHITE,1)}...{RESET()}')
+        else:
+            self.ThreadedPrint(f'{TextColor(WHITE,1)}Linking executable...{RESET()}')
+        if self.debug:
+            self.ThreadedPrint(f'{TextColor(BLUE)}{CommandString(cmd)}{RESET()}')
+        else:
+            src = target.name if target else os.path.normpath(self.GetPath(mode,'objDir'))
+            verb = 'Archiving' if target and target.kind=='static' else 'Linking'
+            self.ThreadedPrint(f'{TextColor(GREEN)}{verb}: {TextColor(BLUE)}{src} {TextColor(WHITE,1)}-> {TextColor(GREEN,1)}{output}{RESET()}')
+        if target and target.kind=='static' and os.path.exists(output):
+            os.remove(output) # ar updates archives in place, objects of removed sources would stay in it
+        code = self.RunCommand(cmd,'link')
+
+        if code!=0 and os.path.exists(output):
+            os.remove(output) # a partial output would look newer than every object
+        statCache.Invalidate(output)
+        if code!=0:
+            self.ThreadedPrint(f"{ERROR()}Linker error!")
+            return False
+        self.commandHashes.Update(output,cmd)
+        if linkInputs:
+            linkInputs.Update(output,objs)
+        if not target: # target links run side by side, their state is saved with the objects
+            self.commandHashes.Save()
+            if linkInputs:
+                linkInputs.Save()
+        return True
+
+    def ParseTargets(self,mode,targets): # return the targets of mode, every target after its deps
+        if type(targets) is not dict:
+            print(f"{ERROR()}'targets' in mode {MODE()}{ModeStr(mode)}{ERROR()} must be a dictionary!")
+            ErrorExit()
+
+        outputDir = self.GetPath(mode,'outputDir')
+        byName = {}
+        for name,t in targets.items():
+            if type(t) is not dict:
+                print(f"{ERROR()}Target '{name}' must be a dictionary!")
+                ErrorExit()
+            kind = t.get('type','executable')
+            if kind not in TARGET_COMMANDS:
+                print(f"{ERROR()}Target '{name}' has unknown type '{kind}'!")
                 ErrorExit()
+            outputName = t.get('outputName',{'executable':name,'static':f'lib{name}.a','shared':f'lib{name}.so'}[kind])
+            patterns = t.get('sources',[])
+            deps = t.get('deps',[])
+            if type(patterns) is str:
+                patterns = [patterns]
+            if type(deps) is str:
+                deps = [deps]
+            patterns = [os.path.normpath(pattern) for pattern in patterns]
+            byName[name] = Target(name,kind,os.path.join(outputDir,outputName),patterns,deps)
 
-        for command in postCmds:
-            self.DebugPrint(f"{TextColor(MAGENTA)}{command}{RESET()}")
-            code = self.RunCommand(command)
-            if code!=0:
+        ordered = []
+        state = {}
+        def Visit(target,path):
+            if state.get(target.name)=='done':
+                return
+            if state.get(target.name)=='visiting':
+                print(f"{ERROR()}Targets depend on each other: {' -> '.join(path+[target.name])}")
+                ErrorExit()
+            state[target.name] = 'visiting'
+            for dep in target.deps:
+                if dep not in byName:
+                    print(f"{ERROR()}Target '{target.name}' depends on unknown target '{dep}'!")
+                    ErrorExit()
+                if byName[dep].kind=='executable':
+                    print(f"{ERROR()}Target '{target.name}' cannot depend on executable '{dep}'!")
+                    ErrorExit()
+                Visit(byName[dep],path+[target.name])
+            state[target.name] = 'done'
+            ordered.append(target)
+
+        for target in byName.values():
+            Visit(target,[])
+
+        order = {target.name:i for i,target in enumerate(ordered)}
+        for target in ordered:
+            target.deps = [byName[dep] for dep in target.deps]
+        for target in ordered:
+            if target.kind!='static': # archives only hold their own objects
+                linkDeps = set()
+                stack = list(target.deps)
+                while stack:
+                    dep = stack.pop()
+                    if dep not in linkDeps:
+                        linkDeps.add(dep)
+                        if dep.kind=='static': # a shared library already contains its deps
+                            stack.extend(dep.deps)
+                target.linkDeps = sorted(linkDeps,key=lambda dep: -order[dep.name])
+                for dep in target.linkDeps:
+                    dep.dependents.append(target)
+                    if target.kind=='shared' and dep.kind=='static':
+                        dep.pic = True
+            target.Reset()
+        return ordered
+
+    def HasTargets(self,mode):
+        return bool(GetModeVar(self.options,mode,'targets'))
+
+    def AssignTargets(self,mode): # with targets, only sources that belong to one are compiled
+        self.targets = []
+        self.targetOf = {}
+        self.targetMode = mode
+        if not self.HasTargets(mode):
+            return
+
+        compiled = self.GetCompiledMode(mode)
+        self.targets = compiled.GetTargets()
+        for target in self.targets:
+            target.Reset()
+        pic = SplitFlag(compiled.Var('picFlag') or '')
+        compiled.extraArgs = {}
+        for src in sorted(self.compileFiles):
+            matches = [target for target in self.targets if target.Matches(src)]
+            if len(matches)>1:
+                print(f"{ERROR()}Source file {src} belongs to targets {', '.join(t.name for t in matches)}!")
                 ErrorExit()
+            if matches:
+                target = matches[0]
+                target.sources.append(src)
+                self.targetOf[src] = target
+                if target.pic and pic:
+                    compiled.extraArgs[src] = pic
+
+        unused = len(self.compileFiles)-len(self.targetOf)
+        if unused:
+            self.DebugPrint(f"{unused} source files are not part of any target.")
+        self.compileFiles = set(self.targetOf)
+
+    def GetOutputPaths(self,mode):
+        if self.HasTargets(mode):
+            return [target.output for target in self.GetCompiledMode(mode).GetTargets()]
+        return [self.GetOutputPath(mode)]
+
+    def FinishBuild(self,mode,postCmds):
+        if self.HasBuildSteps(mode):
+            with self.Trace('write manifest'):
+                self.WriteManifest(mode)
+            self.DebugPrint(self.GetStatCacheSummary())
+
+        self.RunPostCommands(postCmds)
 
         if not self.IsBlankMode(mode):
             self.Done()
+
+    def Clone(self): # a builder for another mode of the same builder file, settings of one mode do not leak into others
+        b = Builder(copy.deepcopy(self.options))
+        b.builderFile = self.builderFile
+        b.debug = self.debug
+        b.quiet = self.quiet
+        b.single = self.single
+        b.jobs = self.jobs
+        b.keepGoing = self.keepGoing
+        b.tracer = self.tracer
+        b.workerAddresses = self.workerAddresses
+        b.remote = self.OpenRemote() # slots are shared by every mode
+        return b
+
+    def BuildModes(self,modes): # plan every mode, then compile and link them all through one job pool
+        builders = [self.Clone() for mode in modes]
+        # every preCmd runs before planning, they may generate files used by other modes
+        started = [b.StartBuild(mode) for b,mode in zip(builders,modes)]
+
+        scheduler = JobScheduler(self.GetWorkerCount(),self.keepGoing)
+        scans = {}
+        try:
+            for b,(mode,postCmds) in zip(builders,started):
+                b.ScheduleBuild(mode,scheduler,scans)
+            with self.Trace('wait for modes'):
+                scheduler.Wait()
+        except BaseException:
+            scheduler.Cancel()
+            raise
+
+        failed = False
+        for b,(mode,postCmds) in zip(builders,started):
+            if not b.FinishScheduledBuild(mode,postCmds):
+                failed = True
+        if failed:
+            ErrorExit()
+
+    def ScheduleBuild(self,mode,scheduler,scans): # queue this mode's compiles, its link is queued once they are done
+        self.linked = None
+        with self.Trace('up to date check'):
+            self.upToDate = self.HasBuildSteps(mode) and self.IsUpToDate(mode)
+        if self.upToDate:
+            self.InfoPrint(f"{MODE()}{ModeStr(mode)}{TextColor(WHITE,1)} is up to date.{RESET()}")
+            return
+
+        self.StartDispatch(scheduler)
+        if self.HasBuildSteps(mode):
+            self.PlanCompiles(mode,scans)
+            if GetModeVar(self.options,mode,'compileCmd')!='' and self.rebuildList:
+                self.InfoPrint(f'{TextColor(WHITE,1)}Building {MODE()}{len(self.rebuildList)}{TextColor(WHITE,1)} files for {MODE()}{ModeStr(mode)}{TextColor(WHITE,1)}...{RESET()}')
+                self.AddCommands(*self.GetCompileJobs(mode,self.rebuildList))
+        self.CloseDispatch(lambda: self.ScheduleLink(mode))
+
+    def PlanCompiles(self,mode,scans): # scans are shared between modes that resolve to the same dirs
+        self.GetDepExtractFunc(mode)
+        compiled = self.GetCompiledMode(mode)
+        srcDirs = self.GetPaths(mode,'srcDirs')
+        key = (tuple(os.path.normpath(d) for d in srcDirs),tuple(os.path.normpath(d) for d in compiled.includeDirs),
+            tuple(self.GetSourceExts(mode)),self.depExtractFunc)
+        if key in scans:
+            self.compileFiles,self.scannedDirs,self.depdict = scans[key]
+            self.rebuildList = []
+            self.DebugPrint(f"Reusing the dependency scan of an earlier mode for {ModeStr(mode)}.")
+        else:
+            with self.Trace('collect sources'):
+                self.CollectAllCompilables(mode,srcDirs,compiled.srcExts)
+            with self.Trace('scan dependencies',files=len(self.compileFiles)):
+                self.ScanAllDependencies(mode)
+            scans[key] = (self.compileFiles,self.scannedDirs,self.depdict)
+
+        with self.Trace('prune objects'):
+            if self.DirContainsObjects(mode):
+                self.PruneObjects(mode)
+        with self.Trace('stale sources'):
+            self.OpenObjectCache(mode)
+            self.StartRebuildSet(mode)
+        if self.UsesPCH(mode):
+            with self.Trace('precompiled header'):
+                if not self.PrecompileHeader(mode):
+                    ErrorExit()
+        with self.Trace('header rebuild set'):
+            self.FinishRebuildSet(mode)
+
+    def ScheduleLink(self,mode): # called by whichever thread finished the mode's last compile
+        if self.targets:
+            return # queued one by one as their inputs finish
+        if self.IsLinking(mode) and not self.dispatchFailed:
+            self.scheduler.Submit(self.LinkJob,(mode,),LINK_PRIORITY)
+
+    def LinkJob(self,mode):
+        self.linked = self.Link(mode)
+        return self.linked
+
+    def FinishScheduledBuild(self,mode,postCmds): # return False if the mode failed
+        if self.upToDate: # the same lines as a single mode build
+            self.InfoPrint(f'{TextColor(WHITE,1)}Up to date.{RESET()}')
+            self.RunPostCommands(postCmds)
+            self.Done()
+            return True
+
+        if self.HasBuildSteps(mode):
+            self.RecordBuiltObjects()
+            self.PrintCriticalPath(time.perf_counter()-self.dispatchStart)
+        if self.dispatchFailed or self.dispatchDone<self.dispatchTotal:
+            self.InfoPrint(f"{ERROR()}Not all files of {MODE()}{ModeStr(mode)}{ERROR()} were successfully compiled!")
+            return False
+        if self.targets:
+            if not self.TargetsBuilt():
+                return False
+        elif self.IsLinking(mode) and not self.linked:
+            return False
+
+        self.FinishBuild(mode,postCmds)
+        return True
+
+    def UpdateDependencies(self,mode,changed): # apply changed paths to the graph, None rescans everything
+        compiled = self.GetCompiledMode(mode)
+        srcDirs = self.GetPaths(mode,'srcDirs')
+        normSrcDirs = [os.path.normpath(d) for d in srcDirs]
+        self.GetDepExtractFunc(mode)
+        self.removedSources = False
+        ResetStatCache()
+
+        full = changed is None or not self.depdict # also after a build answered by the manifest, which scans nothing
+        useCache = changed is not None
+        rescan = []
+        for path in changed or ():
+            tracked = path
+            if path not in self.depdict and path not in self.compileFiles:
+                tracked = os.path.normpath(path)
+            exists = GetFileStat(path) is not None
+            ext = GetExtension(path)
+            if tracked in self.compileFiles:
+                if exists:
+                    rescan.append(tracked)
+                else:
+                    self.compileFiles.discard(tracked)
+                    self.depdict.pop(tracked,None)
+                    self.removedSources = True
+            elif tracked in self.depdict:
+                if exists:
+                    rescan.append(tracked)
+                else:
+                    full = True # files including it may now find the name elsewhere
+                    useCache = False
+            elif exists and ext in compiled.srcExts and IsInDirs(path,normSrcDirs):
+                self.compileFiles.add(path)
+                rescan.append(path)
+            elif exists and ext in compiled.headerExts:
+                full = True # a new header can satisfy or shadow includes of unchanged files
+                useCache = False
+
+        if full:
+            self.DebugPrint("Rescanning every file." if useCache else "Rescanning every file without the dependency cache.")
+            self.CollectAllCompilables(mode,srcDirs,compiled.srcExts)
+            self.ScanAllDependencies(mode,useCache)
+            self.removedSources = True
+        else:
+            includeDirs = compiled.includeDirs
+            self.OpenDepCache(mode,includeDirs,True)
+            for path in rescan:
+                self.FindFileDependencies(path,includeDirs)
+            if self.depCache:
+                self.depCache.Save(True)
+            self.depdict.Compact()
+            self.DebugPrint(f"Rescanned {len(rescan)} changed files.")
+
+    def IsWatchedFile(self,mode,path):
+        compiled = self.GetCompiledMode(mode)
+        ext = GetExtension(path)
+        if ext in compiled.srcExts or ext in compiled.headerExts:
+            return True
+        return path in self.depdict or self.IsBuilderFile(path)
+
+    def IsBuilderFile(self,path):
+        return self.builderFile is not None and os.path.normpath(path)==os.path.normpath(self.builderFile)
+
+    def AddWatchDirs(self,watcher,mode): # recursive dirs come first, so they are not shadowed by single dir watches
+        for d in self.GetPaths(mode,'srcDirs')+self.GetPaths(mode,'includeDirs'):
+            watcher.AddDir(d)
+        dirs = {os.path.dirname(path) or '.' for path in self.depdict}
+        if self.builderFile:
+            dirs.add(os.path.dirname(self.builderFile) or '.')
+        for d in sorted(dirs):
+            watcher.AddDir(d,False)
+
+    def OpenWatcher(self,mode):
+        compiled = self.GetCompiledMode(mode)
+        ignore = [os.path.normpath(compiled.objDir),os.path.normpath(compiled.outputPath)]
+        watcher = OpenWatcher([d for d in ignore if d!='.'])
+        self.AddWatchDirs(watcher,mode)
+        return watcher
+
+    def WatchBuild(self,mode,incremental):
+        try:
+            self.Build(mode,incremental)
+        except SystemExit: # errors are already reported, keep watching for the fix
+            pass
+
+    def Reload(self): # returns False if the builder file is broken, the old options stay in use
+        try:
+            options = GetOptionsFromFile(self.builderFile)
+            self.TestDirs([],options['modes'])
+        except SystemExit:
+            return False
+        self.options = options
+        self.compiledModes = {}
+        return True
+
+    def Watch(self,mode):
+        mode = self.FixMode(mode)
+        self.WatchBuild(mode,False)
+        watcher = self.OpenWatcher(mode)
+        self.DebugPrint(f"Watching with {type(watcher).__name__}.")
+        try:
+            self.InfoPrint(f'{TextColor(WHITE,1)}Watching for changes...{RESET()}')
+            while True:
+                changed = watcher.Wait()
+                if changed is not None:
+                    changed = {path for path in changed if self.IsWatchedFile(mode,path)}
+                    if not changed:
+                        continue
+
+                start = time.perf_counter()
+                if changed is not None and any(self.IsBuilderFile(path) for path in changed):
+                    if not self.Reload():
+                        continue
+                    self.WatchBuild(mode,False)
+                else:
+                    self.UpdateDependencies(mode,changed)
+                    self.WatchBuild(mode,True)
+                self.AddWatchDirs(watcher,mode)
+                self.InfoPrint(f'{TextColor(WHITE,1)}Rebuilt in {MODE()}{(time.perf_counter()-start)*1000:.0f}{TextColor(WHITE,1)} ms{RESET()}')
+                self.InfoPrint(f'{TextColor(WHITE,1)}Watching for changes...{RESET()}')
+        finally:
+            watcher.Close()
+
+    def UsesPCH(self,mode):
+        return bool(self.GetCompiledMode(mode).GetPchArgs())
+
+    def GetIncludeCounts(self,sources,skip): # number of sources including each file, directly or not
+        graph = self.depdict
+        counts = {}
+        for src in sources:
+            start = graph.Node(src)
+            if start is None:
+                continue
+            seen = {start,graph.Node(skip)}
+            stack = [start]
+            while stack:
+                for dep in graph.Deps(stack.pop()):
+                    if dep not in seen:
+                        seen.add(dep)
+                        stack.append(dep)
+                        counts[dep] = counts.get(dep,0)+1
+        return {graph.Path(node):count for node,count in counts.items()}
+
+    def ChoosePchHeaders(self,mode,sources): # a configured list, or the hottest stable headers
+        option = GetModeVar(self.options,mode,'pch')
+        if type(option) is str:
+            option = [option]
+        if type(option) is list:
+            headers = []
+            for header in option:
+                found = [header]+[os.path.join(d,header) for d in self.GetPaths(mode,'includeDirs')]
+                found = [path for path in found if GetFileStat(path) is not None]
+                if not found:
+                    print(f"{ERROR()}Precompiled header '{header}' was not found!")
+                    ErrorExit()
+                headers.append(os.path.normpath(found[0]))
+            return headers
+
+        compiled = self.GetCompiledMode(mode)
+        counts = self.GetIncludeCounts(sources,compiled.pchHeader) # edges to the PCH itself are not real includes
+        minCount = max(2,GetModeVar(self.options,mode,'pchMinShare')*len(sources))
+        hot = {path for path,count in counts.items() if count>=minCount and GetExtension(path) in compiled.headerExts}
+
+        # headers keep their place while they stay hot, so edits do not reshuffle the PCH
+        statePath = self.GetStatePath(mode,'pch.json')
+        state = ReadJSONFile(statePath)
+        previous = state.get('headers',[]) if type(state) is dict else []
+        headers = [path for path in previous if path in hot]
+        stableTime = (time.time()-GetModeVar(self.options,mode,'pchStableAge'))*1e9
+        stable = [path for path in hot if path not in headers and GetFileTime(path)<=stableTime]
+        stable.sort(key=lambda path: (-counts[path],path))
+        headers += stable[:max(0,GetModeVar(self.options,mode,'pchMaxHeaders')-len(headers))]
+        if headers!=previous:
+            WriteJSONFile(statePath,{'headers':headers})
+        return headers
+
+    def PrepareHeader(self,mode): # choose the PCH headers, every source using it depends on them
+        compiled = self.GetCompiledMode(mode)
+        sources = [src for src in self.compileFiles if src not in compiled.extraArgs]
+        self.pchHeaders = self.ChoosePchHeaders(mode,sources)
+        self.DebugPrint(f"Precompiled header: {', '.join(self.pchHeaders) or 'no headers'}")
+
+        text = ''.join(f'#include "{os.path.abspath(path)}"\n' for path in self.pchHeaders)
+        header = compiled.pchHeader
+        try:
+            with open(header,'r') as f:
+                same = f.read()==text
+        except OSError:
+            same = False
+        if not same: # rewriting an unchanged header would rebuild every source
+            d = os.path.dirname(header)
+            if not os.path.exists(d):
+                MakePathSub(d)
+            with open(header,'w') as f:
+                f.write(text)
+            statCache.Invalidate(header)
+
+        # the graph may be shared with other modes, so it is copied before adding the header
+        self.depdict = self.depdict.Copy()
+        self.depdict[header] = set(self.pchHeaders)
+        for src in sources:
+            self.depdict[src] = self.depdict.get(src,set())|{header}
+        self.depdict.Compact()
+
+    def PrecompileHeader(self,mode): # build the PCH before any source that uses it, return False on failure
+        compiled = self.GetCompiledMode(mode)
+        self.PrepareHeader(mode)
+        output = compiled.pchOutput
+        cmd = compiled.GetPchCommand()
+
+        newest = max(GetFileTime(path) for path in self.GetTransitiveDeps(compiled.pchHeader))
+        if not self.commandHashes.Changed(output,cmd) and GetFileTime(output)>newest:
+            return True
+
+        self.InfoPrint(f'{TextColor(WHITE,1)}Precompiling {MODE()}{len(self.pchHeaders)}{TextColor(WHITE,1)} headers...{RESET()}')
+        if self.debug:
+            self.InfoPrint(f'{TextColor(BLUE)}{CommandString(cmd)}{RESET()}')
+        code = self.RunCommand(cmd,'precompile')
+        if code!=0 and os.path.exists(output):
+            os.remove(output)
+        statCache.Invalidate(output)
+        if code!=0:
+            self.InfoPrint(f"{ERROR()}Failed to build precompiled header!")
+            return False
+        self.commandHashes.Update(output,cmd)
+        self.commandHashes.Save()
+        return True
+
+    def LoadUnity(self,mode): # batch object -> the sources compiled into it
+        self.unityBatches = {}
+        data = ReadJSONFile(self.GetStatePath(mode,'unity.json'))
+        if type(data) is dict and data.get('version')==UNITY_VERSION and type(data.get('batches')) is dict:
+            self.unityBatches = data['batches']
+        self.batchOf = {src:obj for obj,members in self.unityBatches.items() for src in members}
+
+    def SaveUnity(self,mode):
+        self.batchOf = {src:obj for obj,members in self.unityBatches.items() for src in members}
+        WriteJSONFile(self.GetStatePath(mode,'unity.json'),{'version':UNITY_VERSION,'batches':self.unityBatches})
+
+    def RemoveFile(self,path):
+        if os.path.exists(path):
+            os.remove(path)
+        statCache.Invalidate(path)
+
+    def IsUnityExcluded(self,mode,src):
+        path = os.path.normpath(src)
+        for pattern in GetModeVar(self.options,mode,'unityExclude'):
+            pattern = os.path.normpath(pattern)
+            if fnmatch.fnmatchcase(path,pattern) or path.startswith(pattern+os.path.sep):
+                return True
+        return False
+
+    def PlanUnity(self,mode,files): # split files into single compiles and unity batches
+        enabled = bool(GetModeVar(self.options,mode,'unity'))
+        batch = enabled and len(files)>=GetModeVar(self.options,mode,'unityMinFiles')
+        stale = set(files)
+        dirty = [obj for obj,members in self.unityBatches.items()
+            if not enabled or any(src in stale or src not in self.compileFiles for src in members)]
+
+        singles = set(files)
+        pool = set()
+        rebatch = []
+        for obj in dirty:
+            members = [src for src in self.unityBatches.pop(obj) if src in self.compileFiles]
+            self.RemoveFile(obj)
+            self.RemoveFile(self.GetUnitySource(mode,obj)) # a batch with the same members writes it again
+            remaining = [src for src in members if src not in stale and not self.IsUnityExcluded(mode,src)]
+            if batch:
+                pool.update(remaining)
+            elif enabled and len(remaining)>1:
+                rebatch.append(remaining) # rebuilt without the changed files, which are compiled on their own
+            else:
+                singles.update(remaining)
+        if batch:
+            pool.update(src for src in files if not self.IsUnityExcluded(mode,src))
+        singles -= pool
+
+        groups = {} # only sources that would be compiled the same way share a batch
+        compiled = self.GetCompiledMode(mode)
+        for src in pool:
+            key = (id(self.targetOf.get(src)),tuple(compiled.extraArgs.get(src,())),GetExtension(src))
+            groups.setdefault(key,[]).append(src)
+        for sources in sorted(groups.values(),key=min):
+            rebatch += self.GroupByHeaders(mode,sources)
+
+        batches = []
+        for members in rebatch:
+            if len(members)==1:
+                singles.add(members[0])
+            else:
+                batches.append(self.AddUnityBatch(mode,members))
+
+        self.SaveUnity(mode)
+        return sorted(singles),batches
+
+    def GroupByHeaders(self,mode,sources): # batches whose sources include as many of the same headers as possible
+        size = GetModeVar(self.options,mode,'unityBatchSize')
+        count = max(-(-len(sources)//size),min(self.GetJobCount(),len(sources)//2),1)
+        size = -(-len(sources)//count)
+
+        headers = {src:self.GetTransitiveDeps(src)-{src} for src in sources}
+        index = {}
+        for src in sources:
+            for header in headers[src]:
+                index.setdefault(header,[]).append(src)
+        # headers most sources include do not tell sources apart, and are the costliest to index
+        common = len(sources)//2
+
+        remaining = set(sources)
+        order = sorted(sources,key=lambda src: (-len(headers[src]),src))
+        batches = []
+        for seed in order:
+            if seed not in remaining:
+                continue
+            remaining.discard(seed)
+            overlap = {}
+            for header in headers[seed]:
+                users = index[header]
+                if len(users)<=common:
+                    for src in users:
+                        if src in remaining:
+                            overlap[src] = overlap.get(src,0)+1
+            # prefer sources that share the most headers with the seed and bring the fewest new ones
+            picked = heapq.nlargest(size-1,overlap,key=lambda src: (2*overlap[src]-len(headers[src]),src))
+            if len(picked)<size-1:
+                picked += [src for src in order if src in remaining and src not in overlap][:size-1-len(picked)]
+            remaining.difference_update(picked)
+            batches.append(sorted([seed]+picked))
+        return batches
+
+    def GetUnitySource(self,mode,obj): # the generated source of a batch object
+        name = os.path.basename(obj)[:-len(self.GetCompiledMode(mode).objExt)-1]
+        return self.GetStatePath(mode,os.path.join('unity',name))
+
+    def AddUnityBatch(self,mode,members): # write the jumbo source, return (source,object,members)
+        compiled = self.GetCompiledMode(mode)
+        name = f"unity_{HashString(';'.join(members))[:16]}.{GetExtension(members[0])}"
+        obj = os.path.join(compiled.objDir,'unity',name+'.'+compiled.objExt)
+        src = self.GetUnitySource(mode,obj)
+
+        text = ''.join(f'#include "{os.path.abspath(member)}"\n' for member in members)
+        d = os.path.dirname(src)
+        if not os.path.exists(d):
+            MakePathSub(d)
+        with open(src,'w') as f:
+            f.write(text)
+        statCache.Invalidate(src)
+
+        for member in members: # every source keeps a single object, so none is linked twice
+            self.RemoveFile(self.GetObjectFromSource(mode,member))
+        if members[0] in compiled.extraArgs:
+            compiled.extraArgs[src] = compiled.extraArgs[members[0]]
+        if members[0] in self.targetOf:
+            self.targetOf[src] = self.targetOf[members[0]]
+        self.unityBatches[obj] = members
+        self.unityMembers[src] = [(member,self.GetObjectFromSource(mode,member)) for member in members]
+        return src,obj,members
+
+    def GetCompileJobs(self,mode,files): # compile jobs and their estimates, with unity batches when enabled
+        if not GetModeVar(self.options,mode,'unity') and not self.unityBatches:
+            return self.GetCompileList(mode,files),self.GetEstimateList(mode,files)
+
+        self.unityMembers = {}
+        singles,batches = self.PlanUnity(mode,files)
+        if batches:
+            self.InfoPrint(f'{TextColor(WHITE,1)}Unity: {MODE()}{sum(len(batch[2]) for batch in batches)}{TextColor(WHITE,1)} files in {MODE()}{len(batches)}{TextColor(WHITE,1)} batches...{RESET()}')
+        compiled = self.GetCompiledMode(mode)
+        jobs = self.GetCompileList(mode,singles)
+        estimates = self.GetEstimateList(mode,singles)
+        for src,obj,members in batches:
+            jobs.append((src,obj,compiled.GetCompileCommand(src,obj)))
+            estimates.append(sum(self.GetCompileEstimate(mode,member) for member in members))
+        return jobs,estimates
+
+    def GetCompileList(self,mode,files):
+        return [(file,self.GetObjectFromSource(mode,file),self.compileCommands[file]) for file in files]
+
+    def GetEstimateList(self,mode,files):
+        return [self.GetCompileEstimate(mode,file) for file in files]
+
+    def CompileObjects(self,mode,incremental=False):
+        self.scheduler = None
+        try:
+            self.CompileObjectsSub(mode,incremental)
+        except BaseException:
+            # compile jobs run in their own process groups, so they would outlive an interrupted build
+            if self.scheduler:
+                self.scheduler.Cancel()
+            raise
+
+    def CompileObjectsSub(self,mode,incremental=False): # sources that are stale on their own start compiling while headers are scanned
+        compiling = GetModeVar(self.options,mode,'compileCmd')!=''
+        self.GetDepExtractFunc(mode)
+        if not incremental:
+            with self.Trace('collect sources'):
+                srcDirs = self.GetPaths(mode,'srcDirs')
+                self.CollectAllCompilables(mode,srcDirs,self.GetSourceExts(mode))
+
+        # pruning first means removed objects are picked up by the rebuild set
+        with self.Trace('prune objects'):
+            if (not incremental or self.removedSources) and self.DirContainsObjects(mode):
+                self.PruneObjects(mode)
+
+        with self.Trace('stale sources'):
+            self.OpenObjectCache(mode)
+            self.StartRebuildSet(mode)
+        early = list(self.rebuildSet)
+        if self.objCache or self.UsesPCH(mode) or GetModeVar(self.options,mode,'unity') or self.unityBatches:
+            early = [] # cache keys include every header and the PCH comes first, so nothing can start before the scan
+        self.SortByEstimate(mode,early)
+        dispatching = compiling and len(early)!=0
+        self.scanning = not incremental
+        if dispatching:
+            self.InfoPrint(f'{TextColor(WHITE,1)}Building {MODE()}{len(early)}{TextColor(WHITE,1)} files...')
+            self.StartDispatch()
+            self.AddCommands(self.GetCompileList(mode,early),self.GetEstimateList(mode,early))
+
+        if not incremental:
+            with self.Trace('scan dependencies',files=len(self.compileFiles)):
+                self.ScanAllDependencies(mode)
+        self.scanning = False
+        if self.UsesPCH(mode):
+            with self.Trace('precompiled header'):
+                if not self.PrecompileHeader(mode):
+                    ErrorExit()
+        with self.Trace('header rebuild set'):
+            self.FinishRebuildSet(mode)
+
+        started = set(early)
+        rest = [file for file in self.rebuildList if file not in started]
+        if compiling and rest:
+            if dispatching:
+                self.InfoPrint(f'{TextColor(WHITE,1)}Building {MODE()}{len(rest)}{TextColor(WHITE,1)} more files...')
+            else:
+                self.InfoPrint(f'{TextColor(WHITE,1)}Building {MODE()}{len(rest)}{TextColor(WHITE,1)} files...')
+                self.StartDispatch()
+                dispatching = True
+            self.AddCommands(*self.GetCompileJobs(mode,rest))
+
+        if self.targets:
+            if not dispatching:
+                self.StartDispatch()
+                dispatching = True
+            self.CloseDispatch(None) # each target is queued once its inputs are done
+        if dispatching:
+            self.FinishDispatch()
+
+    def GetStatCacheSummary(self):
+        return (f"Stat cache: {statCache.lookups} lookups, {statCache.sweeps} directory sweeps, "
+            f"{statCache.statCalls} stats, {statCache.GetSavedCalls()} syscalls saved")
+
+    def RunPostCommands(self,postCmds):
+        for command in postCmds:
+            self.DebugPrint(f"{TextColor(MAGENTA)}{CommandString(command)}{RESET()}")
+            code = self.RunCommand(command,'postCmd')
+            if code!=0:
+                ErrorExit()
             
     def ModeExists(self,mode):
         curr = self.options['modes']
@@ -791,13 +3640,14 @@ class Builder:
         return True
         
     def NeedsCleaning(self,mode):
-        return self.DirContainsObjects(mode) or os.path.exists(self.GetOutputPath(mode))
+        return self.DirContainsObjects(mode) or any(os.path.exists(path) for path in self.GetOutputPaths(mode))
     
     def Clean(self,m):
         subs = GetAllSubModes(GetModeDict(self.options,m)['modes'],m)
         if not subs:
             subs = [m]
             
+        ResetStatCache()
         for mode in subs:
             ext = GetModeVar(self.options,mode,'objExt')
             if self.NeedsCleaning(mode):
@@ -808,15 +3658,17 @@ class Builder:
                     self.InfoPrint(f"{TextColor(YELLOW)}Removing objects in {path}")
                     self.RemoveObjects(path,ext)
                 
-                path = self.GetOutputPath(mode)
-                if os.path.exists(path):
-                    self.InfoPrint(f"{TextColor(YELLOW)}Removing {path}")
-                    os.remove(path)
+                for path in self.GetOutputPaths(mode):
+                    if os.path.exists(path):
+                        self.InfoPrint(f"{TextColor(YELLOW)}Removing {path}")
+                        os.remove(path)
+                        statCache.Invalidate(path)
 		
                 self.Done()
 
     def Stats(self,mode):
         mode = self.FixMode(mode)
+        ResetStatCache()
         
         self.InfoPrint(f"{TextColor(WHITE,1)}Using mode {MODE()}{ModeStr(mode)}{RESET()}")
 
@@ -826,12 +3678,32 @@ class Builder:
         totalSize = GetFileSizes(self.depdict.keys())//1024
 
         justSize = max(GetNumSize(totalSize),GetNumSize(fileCount),GetNumSize(sourceCount))+1
+        if self.depCache:
+            justSize = max(justSize,GetNumSize(self.depCache.hits)+1,GetNumSize(self.depCache.misses)+1)
 
         self.InfoPrint(f"{TextColor(WHITE,1)}Project Stats:")
         self.InfoPrint(f"{TextColor(YELLOW)}File count:   {MODE()}{str(fileCount).rjust(justSize)}")
         self.InfoPrint(f"{TextColor(YELLOW)}Source count: {MODE()}{str(sourceCount).rjust(justSize)}\n")
         
         self.InfoPrint(f"{TextColor(YELLOW,1)}Code size:    {TextColor(GREEN,1)}{str(totalSize).rjust(justSize)}{TextColor(WHITE,1)}K{RESET()}")
+
+        if self.depCache:
+            self.InfoPrint(f"\n{TextColor(WHITE,1)}Dependency Cache:")
+            self.InfoPrint(f"{TextColor(YELLOW)}Hits:         {MODE()}{str(self.depCache.hits).rjust(justSize)}")
+            self.InfoPrint(f"{TextColor(YELLOW)}Misses:       {MODE()}{str(self.depCache.misses).rjust(justSize)}{RESET()}")
+
+        self.InfoPrint(f"\n{TextColor(WHITE,1)}{self.GetStatCacheSummary()}{RESET()}")
+
+        self.OpenObjectCache(mode)
+        if self.objCache:
+            stats = self.objCache.LoadStats()
+            entries = self.objCache.GetEntries()
+            size = sum(e[1] for e in entries)//1024
+            self.InfoPrint(f"\n{TextColor(WHITE,1)}Object Cache ({self.objCache.path}):")
+            self.InfoPrint(f"{TextColor(YELLOW)}Entries:      {MODE()}{str(len(entries)).rjust(justSize)}")
+            self.InfoPrint(f"{TextColor(YELLOW)}Size:         {TextColor(GREEN,1)}{str(size).rjust(justSize)}{TextColor(WHITE,1)}K")
+            self.InfoPrint(f"{TextColor(YELLOW)}Hits:         {MODE()}{str(stats['hits']).rjust(justSize)}")
+            self.InfoPrint(f"{TextColor(YELLOW)}Misses:       {MODE()}{str(stats['misses']).rjust(justSize)}{RESET()}")
     
     def List(self,mode):
         self.FixMode(mode.copy())
@@ -963,7 +3835,7 @@ def ResolveModeStrs(options,mode,curr):
 			
 			ResolveModeStrs(options,mode+[name],d['modes'])
 
-def GetOptionsFromFile(file):
+def FindBuilderFile(file):
     if not os.path.exists(f".{os.path.sep}{file}"):
         if file=='Builderfile':
             file = 'builder.json'
@@ -974,6 +3846,11 @@ def GetOptionsFromFile(file):
             print(f"{ERROR()}No {file} file found!")
             ErrorExit()
 
+    return file
+
+def GetOptionsFromFile(file):
+    file = FindBuilderFile(file)
+
     s = ''
     with open(file,'r') as f:
         s = f.read()
@@ -1015,7 +3892,12 @@ def GetOptionsFromFile(file):
     defaults = [('compileCmd',''),('linkCmd',''),('outputName','a'),
             ('defaultMode',list(op['modes'].keys())[0]),('srcExts',['c','cpp','c++']),
             ('headerExts',['h','hpp','h++']),('objExt','o'),('srcDirs',[]),('includeDirs',[]),
-            ('objDir','.'),('outputDir','.'),('includeFlag','-I'),('preCmds',[]),('postCmds',[])]
+            ('objDir','.'),('outputDir','.'),('includeFlag','-I'),('preCmds',[]),('postCmds',[]),
+            ('depCache',True),('contentHash',False),('scanJobs',1),('scanPool','thread'),('depScanner','regex'),('internGraph',False),
+            ('objCache',False),('objCacheSize',5120),('restat',False),('targets',{}),
+            ('archiveCmd',['ar rcs','%out','%in']),('sharedCmd',['%linkCmd','-shared']),('picFlag','-fPIC'),
+            ('pch',False),('pchMaxHeaders',16),('pchMinShare',0.5),('pchStableAge',86400),
+            ('unity',False),('unityExclude',[]),('unityMinFiles',16),('unityBatchSize',8)]
 
     SetDefaults(op,defaults)
     
@@ -1024,13 +3906,373 @@ def GetOptionsFromFile(file):
 
     return op
 
-def main():    
-    global noColor
-    name = 'builder'
-    builderVersion = '0.1.4'
-    
-    os.system('')
+DAEMON_IDLE_TIMEOUT = 900 # seconds without a request before the server exits
+DAEMON_START_TIMEOUT = 5
+DAEMON_EXIT = b'\0builder-exit '
+
+def GetUid():
+    return os.getuid() if hasattr(os,'getuid') else 0
+
+def GetSocketDir(): # XDG_RUNTIME_DIR is private to the user, the fallback in the shared temp dir is made private
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and os.path.isdir(runtime):
+        return os.path.join(runtime,'builder')
+    return os.path.join(os.environ.get('TMPDIR') or '/tmp',f'builder-{GetUid()}')
+
+def MakePrivateDir(d): # return False if d cannot be made, or another user owns it or can write to it
+    try:
+        os.mkdir(d,0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return False
+    if os.path.islink(d) or not os.path.isdir(d):
+        return False
+    st = os.lstat(d)
+    return st.st_uid==GetUid() and st.st_mode&0o077==0
+
+def GetSocketPath(): # one server per user, directory and version of builder.py
+    stat = os.stat(os.path.abspath(__file__))
+    key = HashString(f'{os.path.realpath(os.getcwd())}:{stat.st_mtime_ns}:{stat.st_size}')[:16]
+    return os.path.join(GetSocketDir(),f'{key}.sock')
+
+def ConnectServer(path): # return a connected socket, None if no server is listening
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+def StartServer():
+    subprocess.Popen([sys.executable,os.path.abspath(__file__),'--serve'],stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL,start_new_session=True)
+
+def RunClient(argv): # forward argv to the server for this directory, starting it if needed, return its exit code
+    if not hasattr(socket,'AF_UNIX'):
+        print(f"{ERROR()}--daemon needs Unix domain sockets!")
+        return 1
+
+    path = GetSocketPath()
+    if not MakePrivateDir(os.path.dirname(path)): # anyone who can write there could pose as the server
+        print(f"{ERROR()}{os.path.dirname(path)} must be a directory only you can write to!")
+        return 1
+    sock = ConnectServer(path)
+    if sock is None:
+        StartServer()
+        deadline = time.monotonic()+DAEMON_START_TIMEOUT
+        while sock is None and time.monotonic()<deadline:
+            time.sleep(0.01)
+            sock = ConnectServer(path)
+        if sock is None:
+            print(f"{ERROR()}Could not start the builder server!")
+            return 1
+
+    request = {'argv':[arg for arg in argv if arg!='--daemon'],'tty':sys.stdout.isatty()}
+    out = sys.stdout.buffer
+    pending = b''
+    keep = len(DAEMON_EXIT)+16 # enough to hold back a split exit marker
+    with sock:
+        sock.sendall((json.dumps(request)+'\n').encode())
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            pending += data
+            if len(pending)>keep:
+                out.write(pending[:-keep])
+                out.flush()
+                pending = pending[-keep:]
+
+    index = pending.rfind(DAEMON_EXIT)
+    if index<0:
+        out.write(pending)
+        out.flush()
+        print(f"{ERROR()}The builder server closed the connection!")
+        return 1
+    out.write(pending[:index])
+    out.flush()
+    return int(pending[index+len(DAEMON_EXIT):])
+
+class BuilderServer: # keeps parsed builder files and the scan results of every mode between requests
+    def __init__(self,path):
+        self.path = path
+        self.files = {}
+        self.modes = {}
+
+    def Serve(self):
+        if not MakePrivateDir(os.path.dirname(self.path)):
+            return
+        sock = ConnectServer(self.path)
+        if sock is not None: # another server won the race
+            sock.close()
+            return
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(16)
+        sock.settimeout(DAEMON_IDLE_TIMEOUT)
+        try:
+            while True:
+                try:
+                    conn,_ = sock.accept()
+                except socket.timeout:
+                    break
+                with conn:
+                    conn.settimeout(None)
+                    self.Handle(conn)
+        finally:
+            sock.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            for b,watcher in self.modes.values():
+                watcher.Close()
+
+    def Handle(self,conn):
+        try:
+            with conn.makefile('rb') as f:
+                request = json.loads(f.readline())
+        except ValueError:
+            return
+
+        out = conn.makefile('w',buffering=1,encoding='utf-8',errors='replace')
+        stdout,stderr = sys.stdout,sys.stderr
+        sys.stdout = sys.stderr = out
+        code = 1
+        try:
+            code = RunArgs(GetArgParser().parse_args(request['argv']),request['tty'],self)
+        except SystemExit as e:
+            code = e.code if type(e.code) is int else int(e.code is not None)
+        except BrokenPipeError: # the client went away, its build is abandoned
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            try:
+                if sys.stdout is not out: # --log
+                    sys.stdout.close()
+                sys.stdout,sys.stderr = stdout,stderr
+                out.close()
+                conn.sendall(DAEMON_EXIT+f'{code}\n'.encode())
+                conn.shutdown(socket.SHUT_RDWR) # objects still holding the file must not keep the client waiting
+            except OSError:
+                pass
+
+    def GetOptions(self,builderFile): # the builder file is parsed again whenever it changes
+        st = os.stat(builderFile)
+        stamp = (st.st_mtime_ns,st.st_size)
+        entry = self.files.get(builderFile)
+        if entry is None or entry[0]!=stamp:
+            entry = (stamp,GetOptionsFromFile(builderFile))
+            self.files[builderFile] = entry
+            for key in [key for key in self.modes if key[0]==builderFile]:
+                self.modes.pop(key)[1].Close()
+        return entry[1]
+
+    def GetBuilder(self,builderFile):
+        b = Builder(copy.deepcopy(self.GetOptions(builderFile)))
+        b.builderFile = builderFile
+        return b
+
+    def Build(self,builderFile,mode,args,tracer): # modes seen before only rescan the files that changed since
+        b = self.GetBuilder(builderFile)
+        fixed = b.FixMode(list(mode))
+        key = (builderFile,ModeStr(fixed))
+        state = self.modes.get(key)
+        if state is None:
+            watcher = b.OpenWatcher(fixed)
+            self.modes[key] = (b,watcher)
+            ConfigureBuilder(b,args,tracer)
+            try:
+                b.Build(mode)
+            finally:
+                b.AddWatchDirs(watcher,fixed)
+            return
+
+        b,watcher = state
+        ConfigureBuilder(b,args,tracer)
+        changed = watcher.Drain()
+        if changed is not None:
+            changed = {path for path in changed if b.IsWatchedFile(fixed,path)}
+        if changed is None or changed or not b.depdict:
+            with b.Trace('update dependencies',changed=len(changed or ())):
+                b.UpdateDependencies(fixed,changed)
+        try:
+            b.Build(mode,True)
+        finally:
+            b.AddWatchDirs(watcher,fixed)
+
+    def Clean(self,builderFile):
+        for key in [key for key in self.modes if key[0]==builderFile]:
+            self.modes.pop(key)[1].Close()
+
+REMOTE_VERSION = 2
+REMOTE_TOKEN_VAR = 'BUILDER_WORKER_TOKEN'
+REMOTE_CONNECT_TIMEOUT = 5
+REMOTE_COMPILE_TIMEOUT = 600
+WORKER_COMPILERS = ('cc','c++','gcc','g++','clang','clang++')
+# flags that make the compiler load code or run programs, also in their joined forms like -fplugin=x.so
+WORKER_UNSAFE_FLAGS = ('-wrapper','-fplugin','-fpass-plugin','-specs','--specs','-B','--prefix','-load','-Xlinker','-Wl,')
+WORKER_OUTPUT_FLAGS = ('-o','-MF','-MT','-MQ','-dumpdir','-dumpbase') # followed by a path the compiler writes
+
+def GetWorkerToken(): # the shared secret of workers and builders, '' if not set
+    return os.environ.get(REMOTE_TOKEN_VAR,'')
+
+def CheckWorkerArgs(args,outputFlags=WORKER_OUTPUT_FLAGS): # return why a worker must not run a command with args, '' if it can
+    pending = None
+    for arg in args:
+        if pending: # the value of an output flag
+            if not IsProjectPath(arg):
+                return f'{pending} must write inside the project\n'
+            pending = None
+            continue
+        if arg.startswith('@'):
+            return 'response files are not allowed\n'
+        for flag in WORKER_UNSAFE_FLAGS:
+            if arg.startswith(flag):
+                return f'{flag} is not allowed on a worker\n'
+        if arg.startswith('-Wp,') or arg.startswith('-Wa,'): # options passed on to the preprocessor or assembler
+            reason = CheckWorkerArgs(arg.split(',')[1:],outputFlags+('-MD','-MMD')) # the preprocessor's -MD takes a file
+            if reason:
+                return reason
+        for flag in outputFlags:
+            if arg==flag:
+                pending = flag
+            elif arg.startswith(flag) and flag in ('-o','-MF') and not IsProjectPath(arg[len(flag):]):
+                return f'{flag} must write inside the project\n'
+    return ''
+
+def ParseAddress(text,defaultHost=''): # 'host:port' or 'port', raises ValueError
+    host,_,port = text.rpartition(':')
+    return (host or defaultHost,int(port))
+
+def IsProjectPath(path): # relative and inside the current directory
+    path = os.path.normpath(path)
+    return not os.path.isabs(path) and path.split(os.path.sep)[0]!='..'
+
+def SendMessage(sock,header,blobs=()): # a length prefixed JSON header, followed by the blobs it describes
+    data = json.dumps(header).encode()
+    sock.sendall(struct.pack('>I',len(data))+data)
+    for blob in blobs:
+        sock.sendall(blob)
 
+def ReadBlob(f,size):
+    data = f.read(size)
+    if len(data)!=size:
+        raise ConnectionError('connection closed')
+    return data
+
+def ReadMessage(f):
+    size = struct.unpack('>I',ReadBlob(f,4))[0]
+    header = json.loads(ReadBlob(f,size))
+    if type(header) is not dict:
+        raise ValueError('bad message')
+    return header
+
+class RemoteWorkers: # compile slots on other machines, a worker that fails is not used again
+    def __init__(self,addresses,localJobs):
+        self.lock = threading.Lock()
+        self.local = threading.Semaphore(localJobs) # remote slots add threads, local compiles stay at -j
+        self.free = []
+        self.dead = set()
+        self.slots = 0
+        for address in addresses:
+            slots = self.Hello(address)
+            self.free += [address]*slots
+            self.slots += slots
+
+    def Hello(self,address): # return the number of slots the worker offers, 0 if it cannot be used
+        try:
+            with socket.create_connection(address,REMOTE_CONNECT_TIMEOUT) as sock:
+                sock.settimeout(REMOTE_CONNECT_TIMEOUT)
+                SendMessage(sock,{'version':REMOTE_VERSION,'op':'hello','token':GetWorkerToken()})
+                with sock.makefile('rb') as f:
+                    reply = ReadMessage(f)
+                    if 'error' in reply:
+                        raise ValueError(reply['error'])
+                    return max(0,int(reply['slots']))
+        except (OSError,ValueError,KeyError,TypeError,ConnectionError) as e:
+            print(f"{TextColor(YELLOW)}Worker {address[0]}:{address[1]} is not available ({e}), compiling locally.{RESET()}")
+            return 0
+
+    def Acquire(self): # a free slot's address, None if every slot is busy
+        with self.lock:
+            return self.free.pop() if self.free else None
+
+    def Release(self,address):
+        with self.lock:
+            if address not in self.dead:
+                self.free.append(address)
+
+    def Drop(self,address):
+        with self.lock:
+            self.dead.add(address)
+            self.free = [a for a in self.free if a!=address]
+
+class CompileWorker: # compiles jobs sent by builders started with --worker and the same token
+    def __init__(self,address,jobs,token):
+        self.address = address
+        self.jobs = jobs
+        self.token = token
+        self.slots = threading.Semaphore(jobs)
+
+    def Serve(self):
+        with socket.create_server(self.address) as sock:
+            print(f"{TextColor(WHITE,1)}Compiling for builders on {MODE()}{self.address[0]}:{self.address[1]}{TextColor(WHITE,1)} with {MODE()}{self.jobs}{TextColor(WHITE,1)} slots{RESET()}",flush=True)
+            while True:
+                conn,_ = sock.accept()
+                threading.Thread(target=self.Handle,args=(conn,),daemon=True).start()
+
+    def Handle(self,conn):
+        try:
+            with conn,conn.makefile('rb') as f:
+                request = ReadMessage(f)
+                if request.get('version')!=REMOTE_VERSION:
+                    return
+                token = request.get('token')
+                if type(token) is not str or not hmac.compare_digest(token.encode(),self.token.encode()):
+                    SendMessage(conn,{'error':'wrong token'})
+                    return
+                if request.get('op')=='hello':
+                    SendMessage(conn,{'slots':self.jobs})
+                    return
+                files = [(path,ReadBlob(f,size)) for path,size in request['files']]
+                reply,data = self.Compile(request['cmd'],request['obj'],files)
+                SendMessage(conn,reply,[data])
+        except (OSError,ValueError,KeyError,TypeError,ConnectionError):
+            pass # the client compiles the job itself
+
+    def Compile(self,cmd,obj,files): # run cmd in a scratch copy of the files, return the reply and the object
+        compiler = os.path.basename(cmd[0]) if cmd else ''
+        if not any(compiler==name or compiler.startswith(name+'-') for name in WORKER_COMPILERS):
+            return {'exit':-1,'output':f'{compiler} is not a compiler this worker runs\n','size':0},b''
+        if not all(IsProjectPath(path) for path,_ in files) or not IsProjectPath(obj):
+            return {'exit':-1,'output':'paths must stay inside the project\n','size':0},b''
+        reason = CheckWorkerArgs(cmd[1:])
+        if reason:
+            return {'exit':-1,'output':reason,'size':0},b''
+
+        with self.slots,tempfile.TemporaryDirectory(prefix='builder-worker-') as root:
+            for path,data in files:
+                full = os.path.join(root,path)
+                os.makedirs(os.path.dirname(full),exist_ok=True)
+                with open(full,'wb') as f:
+                    f.write(data)
+            os.makedirs(os.path.join(root,os.path.dirname(obj)),exist_ok=True)
+            try:
+                p = subprocess.run(cmd,cwd=root,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+            except OSError as e:
+                return {'exit':127,'output':f'{e}\n','size':0},b''
+            data = b''
+            if p.returncode==0:
+                with open(os.path.join(root,obj),'rb') as f:
+                    data = f.read()
+            return {'exit':p.returncode,'output':p.stdout.decode(errors='replace'),'size':len(data)},data
+
+def GetArgParser():
     parser = argparse.ArgumentParser(prog='builder',description="Only builds what needs to be built.")
     group = parser.add_mutually_exclusive_group()
     actions = parser.add_mutually_exclusive_group()
@@ -1039,63 +4281,150 @@ def main():
     actions.add_argument("-c","--clean",help="remove all object and output files",action="store_true")
     actions.add_argument("--stats",action="store_true",help="print stats about the project")
     actions.add_argument("-l","--list",action="store_true",help="print all available modes")
+    actions.add_argument("--check",action="store_true",help="exit with 0 if the modes are up to date, 1 otherwise")
+    actions.add_argument("-w","--watch",action="store_true",help="rebuild the mode whenever its files change")
     parser.add_argument("-s","--single",action="store_true",help="run single-threaded")
+    parser.add_argument("-j","--jobs",metavar='N',type=int,default=0,help="run N compile jobs at once (default: number of cores)")
+    parser.add_argument("-k","--keep-going",action="store_true",help="keep compiling other files after a compile error")
     group.add_argument("-v","--verbose",help="print more info for debugging",action="store_true")
     group.add_argument("-q","--quiet",help="silence builder output",action="store_true")
     parser.add_argument("--log",metavar="FILE",default="",help="write output to the specified log file")
+    parser.add_argument("--trace",metavar="FILE",default="",help="write a Chrome trace of the build to FILE, viewable in Perfetto")
     parser.add_argument("--nocolor",help="disables output of color escape sequences",action="store_true")
+    parser.add_argument("--daemon",action="store_true",help="run through a background server that keeps options and scan results between runs")
+    parser.add_argument("--serve",action="store_true",help=argparse.SUPPRESS)
+    parser.add_argument("--worker",metavar="HOST:PORT",action="append",default=[],help="also compile on the builder worker at HOST:PORT, can be repeated")
+    parser.add_argument("--serve-worker",metavar="[HOST:]PORT",default="",help=f"run a worker that compiles for other builders, with -j slots (default host 127.0.0.1), needs {REMOTE_TOKEN_VAR}")
     parser.add_argument("--version",action="store_true",help='show program\'s version number and exit')
-    args = parser.parse_args()
+    return parser
 
-    if args.nocolor or not sys.stdout.isatty():
-        noColor = True
+def ConfigureBuilder(b,args,tracer=None):
+    b.tracer = tracer
+    b.debug = args.verbose
+    b.quiet = args.quiet
+    b.single = args.single
+    b.jobs = args.jobs
+    b.keepGoing = args.keep_going
+    try:
+        b.workerAddresses = [ParseAddress(worker) for worker in args.worker]
+    except ValueError:
+        print(f"{ERROR()}Workers must be given as HOST:PORT!")
+        ErrorExit()
+    if b.workerAddresses and not GetWorkerToken():
+        print(f"{ERROR()}--worker needs the workers' shared token in {REMOTE_TOKEN_VAR}!")
+        ErrorExit()
 
-    builderLog = ''
+def SetColor(args,tty): # escape sequences only go to terminals
+    global noColor
+    noColor = args.nocolor or not tty
+
+def RunArgs(args,tty,server=None): # return the exit code, server is set when running inside the daemon
+    global noColor
+    name = 'builder'
+    builderVersion = '0.1.4'
+
+    SetColor(args,tty)
 
     if args.log:
         noColor = True
-        sys.stdout.close()
         f = open(args.log,'w')
+        if server is None:
+            sys.stdout.close()
         sys.stdout = f
         sys.stderr = f
     
     if args.version:
         print(f'{TextColor(WHITE,1)}{name} {MODE()}{builderVersion}{RESET()}')
-        quit()
+        return 0
+
+    if server and (args.watch or args.serve):
+        print(f"{ERROR()}--watch cannot be used with --daemon!")
+        return 1
         
     modes = [[]]
     if args.mode!='':
         modes = ParseArgModes(args.mode)
         
-    builderFile = args.b
-    options = GetOptionsFromFile(builderFile)
-    b = Builder(options)
-    
-    if args.verbose:
-        b.debug = True
-    
-    if args.quiet:
-        b.quiet = True
-    
-    if args.single:
-        b.single = True
+    builderFile = FindBuilderFile(args.b)
+    tracer = Tracer() if args.trace else None
+    try:
+        with TraceSpan(tracer,'load builder file','phase',{}):
+            if server:
+                b = server.GetBuilder(builderFile)
+            else:
+                b = Builder(GetOptionsFromFile(builderFile))
+                b.builderFile = builderFile
+        ConfigureBuilder(b,args,tracer)
+        return RunActions(b,args,modes,builderFile,server,tracer)
+    finally:
+        if tracer:
+            tracer.Write(args.trace)
 
+def RunActions(b,args,modes,builderFile,server,tracer):
     if args.list:
         b.List(modes[0])
-        quit()
+        return 0
 
     if args.stats:
         b.Stats(modes[0])
-        quit()
+        return 0
+
+    if args.check:
+        upToDate = True
+        for mode in modes:
+            if not b.Check(mode):
+                upToDate = False
+        print(RESET(),end='')
+        return 0 if upToDate else 1
+
+    if args.watch:
+        if len(modes)>1:
+            print(f"{ERROR()}Only one mode can be watched at a time!")
+            ErrorExit()
+        b.Watch(modes[0])
 
     if args.clean:
+        if server:
+            server.Clean(builderFile)
         for mode in modes:
             b.Clean(mode)
-    else:
+    elif server:
         for mode in modes:
-            b.Build(mode)
+            server.Build(builderFile,mode,args,tracer)
+    elif len(modes)>1:
+        b.BuildModes(modes)
+    else:
+        b.Build(modes[0])
 
     print(RESET(),end='')
+    return 0
+
+def main():    
+    os.system('')
+
+    args = GetArgParser().parse_args()
+    SetColor(args,sys.stdout.isatty())
+    if args.daemon:
+        quit(RunClient(sys.argv[1:]))
+    if args.serve:
+        BuilderServer(GetSocketPath()).Serve()
+        quit()
+    if args.serve_worker:
+        try:
+            address = ParseAddress(args.serve_worker,'127.0.0.1')
+        except ValueError:
+            print(f"{ERROR()}--serve-worker needs a port!")
+            ErrorExit()
+        token = GetWorkerToken()
+        if len(token)<16:
+            print(f"{ERROR()}--serve-worker needs a shared token of at least 16 characters in {REMOTE_TOKEN_VAR}!")
+            ErrorExit()
+        if address[0] not in ('127.0.0.1','::1','localhost'):
+            print(f"{TextColor(YELLOW)}Anyone who can reach {address[0]}:{address[1]} and knows the token can run compilers on this machine.{RESET()}")
+        jobs = 1 if args.single else args.jobs or os.cpu_count() or 1
+        CompileWorker(address,jobs,token).Serve()
+
+    quit(RunArgs(args,sys.stdout.isatty()))
 
 
 if __name__=='__main__':
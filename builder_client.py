@@ -0,0 +1,16 @@
+#!/bin/python
+
+# Thin client for the builder server: `./builder_client.py MODE` is the same as `./builder.py --daemon MODE`.
+# Python compiles a script from source on every run but caches the bytecode of modules it imports,
+# so importing builder.py from here skips compiling it, which costs more than an up to date build
+# through the server.
+
+import sys
+from builder import RunClient
+
+if __name__=='__main__':
+    try:
+        sys.exit(RunClient(sys.argv[1:]))
+    except KeyboardInterrupt:
+        print()
+        sys.exit(1)